@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Benchmark of the parser of the ZAPI responses (NaResponseParser).
+#
+# It generates responses of increasing size and parses them as they arrive
+# from the network, in pieces, reporting the seconds per MB. They should
+# be about the same for all the sizes: the parse time is linear in the size
+# of the response.
+#
+# Usage:
+#
+#    python bench/parse_bench.py [-o] [-c <chunk>] [sizes in KB ...]
+#
+# Where:
+#    -o: also parse with the text of the elements added piece by piece,
+#        as before they were joined once (quadratic, only up to 1 MB)
+#    -c: size of the pieces fed to the parser (default 4096 bytes)
+#
+# Two kinds of responses are generated:
+#    value: one counter with a very long text, like a big array or a
+#           histogram, which expat delivers in many pieces
+#    instances: perf-object-get-instances with many small counters
+
+import os
+import sys
+import time
+import getopt
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'src', 'ontap', 'lib', 'netapp'))
+
+import NaServer
+
+SIZES = [128, 512, 1024, 2048, 4096]
+# sizes in KB parsed with the old parser, it takes minutes above
+OLD_MAX_SIZE = 1024
+
+HEAD = ('<?xml version="1.0" encoding="UTF-8"?>'
+        '<netapp version="1.15" xmlns="http://www.netapp.com/filer/admin">'
+        '<results status="passed">')
+TAIL = '<timestamp>1400000000</timestamp></results></netapp>'
+
+
+class OldResponseParser(NaServer.NaResponseParser):
+    """Adds the text of the elements with every piece from expat."""
+
+    def end_element(self, name):
+        self.TEXT_stack.pop()
+        if (len(self.ZAPI_stack) > 1):
+            n = self.ZAPI_stack.pop()
+            self.ZAPI_stack[-1].child_add(n)
+
+    def char_data(self, data):
+        self.ZAPI_stack[-1].add_content(data)
+
+
+def value_response(size):
+    """Response with a counter of 'size' bytes, a value per line."""
+    parts = [HEAD, '<instances><instance-data><name>vol0</name><counters>',
+             '<counter-data><name>read_latency_hist</name><value>']
+    length = 0
+    i = 0
+    while length < size:
+        value = '%d,\n' % i
+        parts.append(value)
+        length += len(value)
+        i += 1
+    parts.append('0</value></counter-data></counters></instance-data>'
+                 '</instances>')
+    parts.append(TAIL)
+    return ''.join(parts)
+
+
+def instances_response(size):
+    """Response with instances of 20 counters, up to 'size' bytes."""
+    parts = [HEAD, '<instances>']
+    length = 0
+    i = 0
+    while length < size:
+        instance = ['<instance-data><name>vol%d</name><uuid>node:kernel:'
+                    'vol%d</uuid><counters>' % (i, i)]
+        for c in range(20):
+            instance.append(
+                '<counter-data><name>counter%d</name><value>%d</value>'
+                '</counter-data>' % (c, i * c))
+        instance.append('</counters></instance-data>')
+        instance = ''.join(instance)
+        parts.append(instance)
+        length += len(instance)
+        i += 1
+    parts.append('</instances>')
+    parts.append(TAIL)
+    return ''.join(parts)
+
+
+def parse(parser_class, response, chunk):
+    """Returns the seconds to parse the response fed in pieces."""
+    server = NaServer.NaServer('127.0.0.1', 1, 15)
+    start = time.time()
+    parser = parser_class(server)
+    for i in range(0, len(response), chunk):
+        parser.feed(response[i:i + chunk])
+    results = parser.close()
+    elapsed = time.time() - start
+    if results.results_status() != 'passed':
+        raise ValueError(results.results_reason())
+    return elapsed
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hoc:", ["help"])
+    except getopt.GetoptError as e:
+        print(str(e))
+        return 1
+    old = False
+    chunk = 4096
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print("python parse_bench.py [-o] [-c <chunk>] [sizes in KB ...]")
+            return 0
+        elif opt == "-o":
+            old = True
+        elif opt == "-c":
+            chunk = int(arg)
+    sizes = [int(arg) for arg in args] or SIZES
+    print("%-14s %10s %10s %10s" % ("response", "size KB", "seconds", "s/MB"))
+    for kind, generate in (("value", value_response),
+                           ("instances", instances_response)):
+        for size in sizes:
+            response = generate(size * 1024)
+            mb = len(response) / 1048576.0
+            elapsed = parse(NaServer.NaResponseParser, response, chunk)
+            print("%-14s %10i %10.3f %10.3f" % (
+                kind, size, elapsed, elapsed / mb))
+            if old and size <= OLD_MAX_SIZE:
+                elapsed = parse(OldResponseParser, response, chunk)
+                print("%-14s %10i %10.3f %10.3f" % (
+                    kind + " old", size, elapsed, elapsed / mb))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -17,7 +17,7 @@ __version__ = 1.0
 import re
 import sys
 
-class NaElement :
+class NaElement(object) :
     """Class encapsulating Netapp XML request elements.
 
     An NaElement encapsulates one level of an XML element.
@@ -29,12 +29,21 @@ class NaElement :
 
     The following routines are available for constructing and
     accessing the contents of NaElements.
+
+    Responses can have hundreds of thousands of elements, so they
+    are kept in slots instead of a dict per element (which is still
+    available as 'element', see NaElementView) and the children
+    are found by name with an index built on the first lookup.
     """ 
 
 
+    __slots__ = ('name', 'content', 'children', 'attrkeys', 'attrvals', 'index', 'indexed')
+
     #Global Variables
     DEFAULT_KEY = "#u82fyi8S5\017pPemw"
     MAX_CHUNK_SIZE = 256
+    # '&' goes first, not to escape the other entities again
+    XML_ENTITIES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"), ("'", "&apos;"), ('"', "&quot;"))
 
 
     def __init__(self, name, value=None):
@@ -42,9 +51,27 @@ class NaElement :
         optional for top level elements.
         """ 
 
-        self.element = {'name':name,'content':"",'children':[],'attrkeys':[],'attrvals':[]}
+        self.name = name
+        self.content = ""
+        self.children = []
+        # most elements have no attributes, the lists are created by attr_set
+        self.attrkeys = ()
+        self.attrvals = ()
+        self.index = None
+        self.indexed = 0
         if (value != None) :
-            self.element['content'] = value
+            self.content = value
+
+
+
+    def get_element(self):
+        """Returns the element as a dict-like NaElementView with the
+        keys 'name', 'content', 'children', 'attrkeys' and 'attrvals'.
+        """
+
+        return NaElementView(self)
+
+    element = property(get_element)
 
 
     def results_status(self) :
@@ -101,14 +128,7 @@ class NaElement :
         'name', or None if none is found.
         """ 
 
-        arr = self.element['children']
-
-        for i in arr :
-
-            if(name == i.element['name']):
-                return i
-
-        return None
+        return self.child_index().get(name)
 
 
     def set_content(self, content):
@@ -116,7 +136,7 @@ class NaElement :
         not needed in normal development.
         """ 
 
-        self.element['content'] = content
+        self.content = content
 
 
     def add_content(self, content):
@@ -124,7 +144,7 @@ class NaElement :
         not needed in normal development.
         """ 
 
-        self.element['content'] = self.element['content']+content
+        self.content = self.content+content
         return
 
 
@@ -133,9 +153,7 @@ class NaElement :
         """Returns 1 if the element has any children, 0 otherwise
         """ 
 
-        arr = self.element['children']
-
-        if(len(arr)>0):
+        if(len(self.children)>0):
             return 1
 
         else :
@@ -148,9 +166,7 @@ class NaElement :
         the current object, which is also an element.
         """ 
 
-        arr = self.element['children']
-        arr.append(child)
-        self.element['children'] = arr
+        self.children.append(child)
 
 
 
@@ -171,13 +187,12 @@ class NaElement :
         found, returns None.
         """ 
 
-        elts = self.element['children']
+        elt = self.child_index().get(name)
 
-        for elt in elts:
-            if (name == elt.element['name']):
-                return elt.element['content']
+        if (elt == None):
+            return None
 
-        return None
+        return elt.content
 
 
 
@@ -196,8 +211,7 @@ class NaElement :
         """Returns the list of children as an array.
         """ 
 
-        elts = self.element['children']
-        return elts
+        return self.children
 
 
 
@@ -211,10 +225,10 @@ class NaElement :
         Parameter 'indent' is optional.
         """ 
 
-        name = self.element['name']
+        name = self.name
         s = indent+"<"+name
-        keys = self.element['attrkeys']
-        vals = self.element['attrvals']
+        keys = self.attrkeys
+        vals = self.attrvals
         j = 0
 
         for i in keys:
@@ -222,7 +236,7 @@ class NaElement :
             j = j+1
 
         s = s+">"
-        children = self.element['children']
+        children = self.children
 
         if(len(children) > 0):
             s = s+"\n"
@@ -235,7 +249,7 @@ class NaElement :
 
             s = s+c.sprintf(indent + "\t")
 
-        s = s + str(self.element['content'])
+        s = s + str(self.content)
 
         if(len(children) > 0):
             s = s+indent
@@ -296,36 +310,10 @@ class NaElement :
         Example :
         server.invoke("qtree-create","qtree","abc<qt0","volume","vol0")
         """ 
-        n = self.element['name']
-        s = "<"+n
-        keys = self.element['attrkeys']
-        vals = self.element['attrvals']
-        j = 0
-
-        for i in keys :
-            s = s+" "+str(i)+"=\""+str(vals[j])+"\""
-            j = j+1
-
-        s = s+">"
-        children = self.element['children']
-
-        for i in children :
-            c = i
-                      
-            if (not re.search("NaElement.NaElement",str(c.__class__),re.I)):
-                sys.exit("Unexpected reference found, expected NaElement.NaElement not "+ str(c.__class__)+"\n")
-
-            s = s+c.toEncodedString()
 
-        cont = str(self.element['content'])
-        re.sub(r'&','&amp;',cont,count=0)
-        re.sub(r'<','&lt;',cont,count=0)
-        re.sub(r'>','&gt;',cont,count=0)
-        re.sub(r"'",'&apos;',cont,count=0)
-        re.sub(r'"','&quot;',cont,count=0)
-        s = s+cont
-        s = s+"</"+n+">"
-        return s
+        s = []
+        self.encode_into(s)
+        return "".join(s)
 
 
 
@@ -392,12 +380,12 @@ class NaElement :
         """This is a private function, not to be called from outside NaElement.
         """ 
 
-        arr = self.element['attrkeys']
-        arr.append(key)
-        self.element['attrkeys'] = arr
-        arr = self.element['attrvals']
-        arr.append(value)
-        self.element['attrvals'] = arr
+        if (len(self.attrkeys) == 0):
+            self.attrkeys = []
+            self.attrvals = []
+
+        self.attrkeys.append(key)
+        self.attrvals.append(value)
 
 
 
@@ -405,8 +393,8 @@ class NaElement :
         """This is a private function, not to be called from outside NaElement.
         """ 
 
-        keys = self.element['attrkeys']
-        vals = self.element['attrvals']
+        keys = self.attrkeys
+        vals = self.attrvals
         j = 0
 
         for i in keys:
@@ -416,3 +404,130 @@ class NaElement :
             j = j+1
 
         return None
+
+
+
+    def encode_into(self, s):
+        """This is a private function, not to be called from outside NaElement.
+        """ 
+
+        n = self.name
+        s.append("<"+n)
+        vals = self.attrvals
+        j = 0
+
+        for i in self.attrkeys :
+            s.append(" "+str(i)+"=\""+self.escape(str(vals[j]))+"\"")
+            j = j+1
+
+        s.append(">")
+
+        for c in self.children :
+
+            if (not isinstance(c, NaElement)):
+                sys.exit("Unexpected reference found, expected NaElement.NaElement not "+ str(c.__class__)+"\n")
+
+            c.encode_into(s)
+
+        s.append(self.escape(str(self.content)))
+        s.append("</"+n+">")
+
+
+
+    def escape(self, value):
+        """This is a private function, not to be called from outside NaElement.
+        """ 
+
+        for (c, entity) in self.XML_ENTITIES:
+            if (c in value):
+                value = value.replace(c, entity)
+
+        return value
+
+
+
+    def child_index(self):
+        """This is a private function, not to be called from outside NaElement.
+        """ 
+
+        children = self.children
+
+        if (self.index == None or self.indexed != len(children)):
+            # like a scan of the children, the first one of a name wins
+            index = {}
+            for i in reversed(children):
+                index[i.name] = i
+            self.index = index
+            self.indexed = len(children)
+
+        return self.index
+
+
+
+class NaElementView(object) :
+    """Dict-like view of an NaElement with the keys of the dict
+    used by earlier versions: 'name', 'content', 'children',
+    'attrkeys' and 'attrvals'. Changes are made on the element.
+    """
+
+
+    __slots__ = ('elt',)
+
+    KEYS = ('name', 'content', 'children', 'attrkeys', 'attrvals')
+
+
+    def __init__(self, elt):
+        self.elt = elt
+
+
+    def __getitem__(self, key):
+        if (key not in self.KEYS):
+            raise KeyError(key)
+
+        return self.value(key)
+
+
+    def __setitem__(self, key, value):
+        if (key not in self.KEYS):
+            raise KeyError(key)
+
+        setattr(self.elt, key, value)
+        if (key == 'children'):
+            self.elt.index = None
+
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+
+    def keys(self):
+        return list(self.KEYS)
+
+
+    def get(self, key, default=None):
+        if (key not in self.KEYS):
+            return default
+
+        return self.value(key)
+
+
+
+    def value(self, key):
+        """This is a private function, not to be called from outside
+    NaElement. The lists returned can be changed by the caller, as the
+    ones of the dict: the attribute lists are created if the element
+    has none and the index of the children is built again on the next
+    lookup.
+    """
+
+        elt = self.elt
+        if (key == 'children'):
+            elt.index = None
+        elif (key in ('attrkeys', 'attrvals') and len(elt.attrkeys) == 0):
+            elt.attrkeys = []
+            elt.attrvals = []
+        return getattr(elt, key)
@@ -18,6 +18,11 @@ from NaElement import *
 import base64
 import xml.parsers.expat
 import socket
+import select
+import threading
+import time
+import errno
+import os
 
 ssl_import = True
 try:
@@ -30,6 +35,7 @@ except ImportError:
 python_version = float(str(sys.version_info[0]) + "." + str(sys.version_info[1]))
 
 socket_ssl_attr = True
+ssl_context_attr = (ssl_import and hasattr(ssl, 'SSLContext'))
 if(python_version < 3.0):
     import httplib
     if(hasattr(socket, 'ssl') != True):
@@ -102,8 +108,14 @@ class NaServer :
         self.need_cn_verification = False
         self.url = FILER_URL
         self.dtd = FILER_dtd
-        self.ZAPI_stack = []
-        self.ZAPI_atts = {}
+        self.read_size = 65536
+        self.keep_alive = True
+        self.pool_size = 4
+        self.pool_idle_timeout = 120
+        self.pool = []
+        self.pool_lock = threading.Lock()
+        self.ssl_context = None
+        self.verified_cert = None
 
 
 
@@ -366,107 +378,75 @@ class NaServer :
 
 
 
-    def invoke_elem(self, req):
+    def invoke_elem(self, req, parser=None):
         """Submit an XML request already encapsulated as
         an NaElement and return the result in another
         NaElement.
+
+        'parser' can be given to parse the response with another
+        object than NaResponseParser, having the same feed() and
+        close() methods; the result is then what its close() returns.
+
+        When keep-alive is enabled (the default) the HTTP(S)
+        connection is taken from the connection pool of this
+        server and given back once the response has been read.
+        A pooled connection closed by the server in the meantime
+        is detected and the request is retried once on a new one;
+        requests which cannot be sent twice (see can_resend) are
+        only retried if they could not be sent.
         """
      
-        server = self.server
-        user = self.user
-        password = self.password
         debug_style = self.debug_style
-        vfiler = self.vfiler
-        originator_id = self.originator_id
-        server_type = self.server_type
-        xmlrequest = req.toEncodedString()
-        url = self.url
-        vfiler_req = ""
-        originator_id_req = ""
-
-        try:
+        (content, authheader) = self.build_request(req)
+        resend = self.can_resend(req)
 
-            if(self.transport_type == "HTTP"):
-                    if(python_version < 2.6):  # python versions prior to 2.6 do not support 'timeout'
-                        connection = httplib.HTTPConnection(server, port=self.port)
-                    else :
-                        connection = httplib.HTTPConnection(server, port=self.port, timeout=self.timeout)
-
-            else : # for HTTPS
-
-                    if (self.need_cba == True or self.need_server_auth == True):
-                        if (python_version < 2.6):
-                            cba_err = "certificate based authentication is not supported with Python " + str(python_version) + "." 
-                            return self.fail_response(13001, cba_err) 
-                        connection = CustomHTTPSConnection(server, self.port, key_file=self.key_file, 
-                        cert_file=self.cert_file, ca_file=self.ca_file, 
-                        need_server_auth=self.need_server_auth, 
-                        need_cn_verification=self.need_cn_verification, 
-                        timeout=self.timeout)
-                        connection.connect()
-                        if (self.need_cn_verification == True):
-                            cn_name = connection.get_commonName()
-                            if (cn_name.lower() != server.lower()) :
-                                cert_err = "server certificate verification failed: server certificate name (CN=" + cn_name + "), hostname (" + server + ") mismatch."
-                                connection.close()
-                                return self.fail_response(13001, cert_err)
-                    else :
-                        if(python_version < 2.6): # python versions prior to 2.6 do not support 'timeout'
-                            connection = httplib.HTTPSConnection(server, port=self.port)
-                        else :
-                            connection = httplib.HTTPSConnection(server, port=self.port, timeout=self.timeout)
+        while True:
+            connection = self.pool_get()
+            reused = (connection != None)
 
-            connection.putrequest("POST", self.url)
-            connection.putheader("Content-type", "text/xml; charset=\"UTF-8\"")
+            if (not reused):
+                connection = self.open_connection()
+                if (isinstance(connection, NaElement)):
+                    return connection
 
-            if(self.get_style() != "HOSTS"):
+            try:
+                self.send_request(connection, content, authheader)
 
-                if(python_version < 3.0):
-                    base64string = base64.encodestring("%s:%s" %(user,password))[:-1]
-                    authheader = "Basic %s" %base64string
-                elif(python_version == 3.0):
-                    base64string = base64.encodestring(('%s:%s' %( user, password)).encode())
-                    authheader = "Basic %s" % base64string.decode().strip()
+            except socket.error :
+                connection.close()
+                if (reused and not isinstance(sys.exc_info()[1], socket.timeout)):
+                    # stale keep-alive connection, retry on a new one
+                    continue
+                message = sys.exc_info()
+                return (self.fail_response(13001, message[1]))
+
+            streamed = False
+            try:
+                response = connection.getresponse()
+                if (response.status == 401 or self.is_debugging() > 0):
+                    xml_response = response.read()
                 else:
-                    base64string = base64.encodebytes(('%s:%s' %( user, password)).encode())
-                    authheader = "Basic %s" % base64string.decode().strip()
-
-                connection.putheader("Authorization", authheader)
-
-            if(vfiler != ""):
-                vfiler_req = " vfiler=\"" + vfiler + "\""
-
-            if(originator_id != ""):
-                originator_id_req = " originator_id=\"" + originator_id + "\""
-
-
-            content = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'\
-                     +'\n'+\
-                     '<!DOCTYPE netapp SYSTEM \'' + self.dtd + '\''\
-                     '>' \
-                     '<netapp' \
-                     + vfiler_req + originator_id_req + \
-                     ' version="'+str(self.major_version)+'.'+str(self.minor_version)+'"'+' xmlns="' + ZAPI_xmlns + '">'\
-                     + xmlrequest + '</netapp>'
-
-            if(debug_style == "NA_PRINT_DONT_PARSE"):
-                print(("INPUT \n" +content))
-
-            if(python_version < 3.0):
-                connection.putheader("Content-length", len(content))
-                connection.endheaders()
-                connection.send(content)
-            else :
-                connection.putheader("Content-length", str(len(content)))
-                connection.endheaders()
-                connection.send(content.encode())
-
+                    # parse the response while it is being received
+                    if (parser == None):
+                        parser = NaResponseParser(self)
+                    data = response.read(self.read_size)
+                    streamed = True
+                    while (len(data) > 0):
+                        parser.feed(data)
+                        data = response.read(self.read_size)
+
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if (reused and resend and not streamed and not isinstance(sys.exc_info()[1], socket.timeout)):
+                    # the server closed the connection before answering
+                    continue
+                raise
 
-        except socket.error :
-            message = sys.exc_info()
-            return (self.fail_response(13001, message[1]))
+            except xml.parsers.expat.ExpatError:
+                connection.close()
+                raise
 
-        response = connection.getresponse()
+            break
     
         if not response :
             connection.close()
@@ -476,8 +456,6 @@ class NaServer :
             connection.close()
             return self.fail_response(13002,"Authorization failed")
 
-        xml_response = response.read()
-
         if(self.is_debugging() > 0):
 
             if(debug_style != "NA_PRINT_DONT_PARSE"):
@@ -486,8 +464,64 @@ class NaServer :
                 connection.close()
                 return self.fail_response(13001, "debugging bypassed xml parsing")
         
-        connection.close()
-        return self.parse_xml(xml_response)
+        self.pool_put(connection, response)
+        if (not streamed):
+            if (parser == None):
+                return self.parse_xml(xml_response)
+            parser.feed(xml_response)
+        return parser.close()
+
+
+
+    def invoke_elem_async(self, req, loop, callback, parser=None):
+        """Submit an XML request already encapsulated as an
+        NaElement without waiting for the answer. The request
+        is processed by the NaEventLoop 'loop', which can run
+        many of them at the same time, and 'callback' is called
+        from the loop with the result NaElement, or with a
+        failed one if the request cannot be completed.
+        'parser' is used as in invoke_elem().
+
+        It is only available for HTTP, and HTTPS with Python 2.7.9
+        or later.
+        """
+
+        if (self.use_https() and not ssl_context_attr):
+            callback(self.fail_response(13001, "in NaServer::invoke_elem_async: HTTPS needs ssl.SSLContext"))
+            return
+        (content, authheader) = self.build_request(req)
+        if ((self.use_https() and self.port == 443) or (not self.use_https() and self.port == 80)):
+            host = self.server
+        else:
+            host = self.server + ":" + str(self.port)
+        headers = ["POST " + self.url + " HTTP/1.1",
+                   "Host: " + host,
+                   "Accept-Encoding: identity",
+                   "Content-type: text/xml; charset=\"UTF-8\""]
+        if (authheader != None):
+            headers.append("Authorization: " + authheader)
+        if (not self.keep_alive):
+            headers.append("Connection: close")
+        if (python_version >= 3.0):
+            content = content.encode()
+        headers.append("Content-length: " + str(len(content)))
+        data = "\r\n".join(headers) + "\r\n\r\n"
+        if (python_version >= 3.0):
+            data = data.encode()
+        loop.submit(self, data + content, callback, parser, self.can_resend(req))
+
+
+
+    def can_resend(self, req):
+        """This is a private function, not to be called from outside NaServer
+
+    Returns False for the requests which cannot be sent again once
+    the server may have received them: the next page of an iterator
+    would be skipped, or an ended iterator would not be found.
+    """
+
+        name = req.name
+        return not (name.endswith("-iter-next") or name.endswith("-iter-end"))
 
 
 
@@ -553,6 +587,53 @@ class NaServer :
 
         return self.timeout
 
+
+
+    def set_keep_alive(self, enable, pool_size=None, idle_timeout=None):
+        """Enables or disables persistent (keep-alive) HTTP/1.1
+    connections. When enabled, connections are kept in a pool of
+    at most 'pool_size' idle connections and reused by the next
+    invoke_elem() calls, until they have been idle for more than
+    'idle_timeout' seconds. Keep-alive is enabled by default.
+    """
+
+        if (enable != True and enable != False):
+            return self.fail_response(13001, "NaServer::set_keep_alive: invalid argument " + str(enable) + " specified")
+        self.keep_alive = enable
+        if (pool_size != None):
+            self.pool_size = int(pool_size)
+        if (idle_timeout != None):
+            self.pool_idle_timeout = float(idle_timeout)
+        if (not enable):
+            self.close()
+        return None
+
+
+
+    def is_keep_alive_enabled(self):
+        """ Determines whether persistent connections are enabled or not.
+        Returns True if it is enabled, else returns False
+        """
+
+        return self.keep_alive
+
+
+
+    def close(self):
+        """Closes all the idle connections kept in the connection pool.
+    The server context can still be used afterwards, new connections
+    will be opened when needed.
+    """
+
+        self.pool_lock.acquire()
+        try:
+            pool = self.pool
+            self.pool = []
+        finally:
+            self.pool_lock.release()
+        for (connection, last_used) in pool:
+            connection.close()
+
     def set_client_cert_and_key(self, cert_file, key_file):
         """ Sets the client certificate and key files that are required for client authentication
         by the server using certificates. If key file is not defined, then the certificate file 
@@ -564,6 +645,7 @@ class NaServer :
             self.key_file = key_file
         else:
             self.key_file = cert_file
+        self.reset_ssl_context()
 
     def set_ca_certs(self, ca_file):
         """ Specifies the certificates of the Certificate Authorities (CAs) that are 
@@ -571,6 +653,7 @@ class NaServer :
         """
 
         self.ca_file = ca_file
+        self.reset_ssl_context()
 
     def set_server_cert_verification(self, enable):
         """ Enables or disables server certificate verification by the client.
@@ -588,6 +671,7 @@ class NaServer :
             return self.fail_response(13001,"in NaServer::set_server_cert_verification: server certificate verification cannot be used as 'ssl' module is not imported.")
         self.need_server_auth = enable
         self.need_cn_verification = enable
+        self.reset_ssl_context()
         return None
 
     def is_server_cert_verification_enabled(self):
@@ -607,6 +691,7 @@ class NaServer :
         if (self.need_server_auth == False):
             return self.fail_response(13001, "in NaServer::set_hostname_verification: server certificate verification is not enabled")
         self.need_cn_verification = enable
+        self.reset_ssl_context()
         return None;
 
     def is_hostname_verification_enabled(self):
@@ -632,103 +717,383 @@ class NaServer :
 
 
 
-    def start_element(self, name, attrs):
-        """This is a private function, not to be called from outside NaElement
+    def build_request(self, req):
+        """This is a private function, not to be called from outside NaServer
         """
 
-        n = NaElement(name)
-        self.ZAPI_stack.append(n)
-        self.ZAPI_atts = {}
-        attr_name = list(attrs.keys())
-        attr_value = list(attrs.values())
-        i = 0
-        for att in attr_name :
-            val = attr_value[i]
-            i = i+1
-            self.ZAPI_atts[att] = val
-            n.attr_set(att,val)
+        user = self.user
+        password = self.password
+        debug_style = self.debug_style
+        vfiler = self.vfiler
+        originator_id = self.originator_id
+        xmlrequest = req.toEncodedString()
+        vfiler_req = ""
+        originator_id_req = ""
 
+        if(vfiler != ""):
+            vfiler_req = " vfiler=\"" + vfiler + "\""
 
+        if(originator_id != ""):
+            originator_id_req = " originator_id=\"" + originator_id + "\""
 
-    def end_element(self, name):
-        """This is a private function, not to be called from outside NaElement
+
+        content = '<?xml version=\'1.0\' encoding=\'utf-8\'?>'\
+                 +'\n'+\
+                 '<!DOCTYPE netapp SYSTEM \'' + self.dtd + '\''\
+                 '>' \
+                 '<netapp' \
+                 + vfiler_req + originator_id_req + \
+                 ' version="'+str(self.major_version)+'.'+str(self.minor_version)+'"'+' xmlns="' + ZAPI_xmlns + '">'\
+                 + xmlrequest + '</netapp>'
+
+        if(debug_style == "NA_PRINT_DONT_PARSE"):
+            print(("INPUT \n" +content))
+
+        authheader = None
+        if(self.get_style() != "HOSTS"):
+
+            if(python_version < 3.0):
+                base64string = base64.encodestring("%s:%s" %(user,password))[:-1]
+                authheader = "Basic %s" %base64string
+            elif(python_version == 3.0):
+                base64string = base64.encodestring(('%s:%s' %( user, password)).encode())
+                authheader = "Basic %s" % base64string.decode().strip()
+            else:
+                base64string = base64.encodebytes(('%s:%s' %( user, password)).encode())
+                authheader = "Basic %s" % base64string.decode().strip()
+
+        return (content, authheader)
+
+
+
+    def open_connection(self):
+        """This is a private function, not to be called from outside NaServer
         """
 
-        stack_len = len(self.ZAPI_stack)
+        server = self.server
+        try:
 
-        if (stack_len > 1):
-            n = self.ZAPI_stack.pop(stack_len - 1)
-            i = len(self.ZAPI_stack)
+            if(self.transport_type == "HTTP"):
+                    if(python_version < 2.6):  # python versions prior to 2.6 do not support 'timeout'
+                        connection = httplib.HTTPConnection(server, port=self.port)
+                    else :
+                        connection = httplib.HTTPConnection(server, port=self.port, timeout=self.timeout)
 
-            if(i != stack_len - 1):
-                print("pop did not work!!!!\n")
+            elif (ssl_context_attr): # for HTTPS, with a reusable SSL context
 
-            self.ZAPI_stack[i-1].child_add(n)
+                    connection = CustomHTTPSConnection(server, self.port, key_file=self.key_file,
+                    cert_file=self.cert_file, ca_file=self.ca_file,
+                    need_server_auth=self.need_server_auth,
+                    need_cn_verification=self.need_cn_verification,
+                    timeout=self.timeout, context=self.get_ssl_context())
+                    connection.connect()
+                    ret = self.verify_ssl_socket(connection.sock)
+                    if (ret):
+                        connection.close()
+                        return ret
 
+            else : # for HTTPS
 
+                    if (self.need_cba == True or self.need_server_auth == True):
+                        if (python_version < 2.6):
+                            cba_err = "certificate based authentication is not supported with Python " + str(python_version) + "." 
+                            return self.fail_response(13001, cba_err) 
+                        connection = CustomHTTPSConnection(server, self.port, key_file=self.key_file, 
+                        cert_file=self.cert_file, ca_file=self.ca_file, 
+                        need_server_auth=self.need_server_auth, 
+                        need_cn_verification=self.need_cn_verification, 
+                        timeout=self.timeout)
+                        connection.connect()
+                        if (self.need_cn_verification == True):
+                            cn_name = connection.get_commonName()
+                            if (cn_name.lower() != server.lower()) :
+                                cert_err = "server certificate verification failed: server certificate name (CN=" + cn_name + "), hostname (" + server + ") mismatch."
+                                connection.close()
+                                return self.fail_response(13001, cert_err)
+                    else :
+                        if(python_version < 2.6): # python versions prior to 2.6 do not support 'timeout'
+                            connection = httplib.HTTPSConnection(server, port=self.port)
+                        else :
+                            connection = httplib.HTTPSConnection(server, port=self.port, timeout=self.timeout)
 
-    def char_data(self, data):
-        """This is a private function, not to be called from outside NaElement
+        except socket.error :
+            message = sys.exc_info()
+            return (self.fail_response(13001, message[1]))
+
+        return connection
+
+
+
+    def get_ssl_context(self):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        context = self.ssl_context
+        if (context != None):
+            return context
+
+        if (self.need_cba == True or self.need_server_auth == True or self.cert_file != None):
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            if (self.need_server_auth == True):
+                context.verify_mode = ssl.CERT_REQUIRED
+                if (self.ca_file != None):
+                    context.load_verify_locations(self.ca_file)
+                else:
+                    context.load_default_certs()
+            if (self.cert_file != None):
+                context.load_cert_chain(self.cert_file, self.key_file)
+        else:
+            # the context httplib.HTTPSConnection gets by default, which
+            # follows PYTHONHTTPSVERIFY and the site-wide overrides
+            context = ssl._create_default_https_context()
+        self.ssl_context = context
+        return context
+
+
+
+    def reset_ssl_context(self):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        self.ssl_context = None
+        self.verified_cert = None
+        self.close()
+
+
+
+
+    def verify_ssl_socket(self, sock):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        if (self.need_cn_verification == True):
+            # the certificate name is only checked once for
+            # every new certificate presented by the server
+            cert = sock.getpeercert(True)
+            if (cert != self.verified_cert):
+                cn_name = ""
+                for x in sock.getpeercert()['subject'] :
+                    if (x[0][0].lower() == 'commonname') :
+                        cn_name = x[0][1]
+                        break
+                if (cn_name.lower() != self.server.lower()) :
+                    cert_err = "server certificate verification failed: server certificate name (CN=" + cn_name + "), hostname (" + self.server + ") mismatch."
+                    return self.fail_response(13001, cert_err)
+                self.verified_cert = cert
+        return None
+
+
+
+    def send_request(self, connection, content, authheader):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        connection.putrequest("POST", self.url)
+        connection.putheader("Content-type", "text/xml; charset=\"UTF-8\"")
+
+        if(authheader != None):
+            connection.putheader("Authorization", authheader)
+
+        if(python_version < 3.0):
+            connection.putheader("Content-length", len(content))
+            connection.endheaders()
+            connection.send(content)
+        else :
+            connection.putheader("Content-length", str(len(content)))
+            connection.endheaders()
+            connection.send(content.encode())
+
+
+
+    def pool_get(self):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        if (not self.keep_alive):
+            return None
+        now = time.time()
+        self.pool_lock.acquire()
+        try:
+            while (len(self.pool) > 0):
+                (connection, last_used) = self.pool.pop()
+                if (now - last_used <= self.pool_idle_timeout and self.is_alive(connection)):
+                    return connection
+                connection.close()
+        finally:
+            self.pool_lock.release()
+        return None
+
+
+
+    def pool_put(self, connection, response):
+        """This is a private function, not to be called from outside NaServer
         """
 
-        i = len(self.ZAPI_stack)
-        self.ZAPI_stack[i-1].add_content(data)
+        if (not self.keep_alive or response.will_close):
+            connection.close()
+            return
+        self.pool_lock.acquire()
+        try:
+            if (len(self.pool) < self.pool_size):
+                self.pool.append((connection, time.time()))
+                return
+        finally:
+            self.pool_lock.release()
+        connection.close()
+
+
+
+    def is_alive(self, connection):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        # An idle keep-alive socket must not be readable: if it is,
+        # the server has closed it (EOF) or sent something unexpected.
+        sock = connection.sock
+        if (sock == None):
+            return False
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return (len(readable) == 0)
 
 
 
     def parse_xml(self, xmlresponse):
         """This is a private function, not to be called from outside NaElement
         """
-        p = xml.parsers.expat.ParserCreate()
-        p.StartElementHandler = self.start_element
-        p.EndElementHandler = self.end_element
-        p.CharacterDataHandler = self.char_data
-        p.Parse(xmlresponse, 1)
+
+        p = NaResponseParser(self)
+        p.feed(xmlresponse)
+        return p.close()
+
+
+
+    def parse_raw_xml(self, xmlrequest):
+        """This is a private function, not to be called from outside NaElement
+        """
+
+        p = NaResponseParser(self, raw=True)
+        p.feed(xmlrequest)
+        return p.close()
+
+
+
+class NaResponseParser :
+    """Incremental parser of the XML of a ZAPI response.
+
+    The response can be given in pieces with feed() as it arrives
+    from the network, so it is parsed while it is transferred and
+    it never needs to be completely in memory as raw text. Each
+    parser has its own state, many of them can be used at the
+    same time from different threads. expat can deliver the text
+    of an element in many pieces, they are kept in a list and
+    joined once when the element ends.
+    This is a private class, not to be used from outside NaServer.
+    """
+
+
+
+    def __init__(self, server, raw=False):
+        self.server = server
+        self.raw = raw
+        self.ZAPI_stack = []
+        self.TEXT_stack = []
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.char_data
+
+
+
+    def feed(self, data):
+        """Parse the next piece of the response.
+        """
+
+        self.parser.Parse(data, 0)
+
+
+
+    def close(self):
+        """Finish the parsing and return the results element
+        (or the root element if it is raw).
+        """
+
+        self.parser.Parse(b"", 1)
+        self.parser = None
         stack_len = len(self.ZAPI_stack)
 
         if(stack_len <= 0):
-            return self.fail_response(13001,"Zapi::parse_xml-no elements on stack")
+            return self.server.fail_response(13001,"Zapi::parse_xml-no elements on stack")
 
         r = self.ZAPI_stack.pop(stack_len - 1)
 
+        if (self.raw):
+            return r
+
         if (r.element['name'] != "netapp") :
-            return self.fail_response(13001, "Zapi::parse_xml - Expected <netapp> element but got " + r.element['name'])
+            return self.server.fail_response(13001, "Zapi::parse_xml - Expected <netapp> element but got " + r.element['name'])
 
         results = r.child_get("results")
 
         if (results == None) :
-            return self.fail_response(13001, "Zapi::parse_xml - No results element in output!")
+            return self.server.fail_response(13001, "Zapi::parse_xml - No results element in output!")
 
         return results
 
 
 
-    def parse_raw_xml(self, xmlrequest):
-        """This is a private function, not to be called from outside NaElement
+    def start_element(self, name, attrs):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        n = NaElement(name)
+        self.ZAPI_stack.append(n)
+        self.TEXT_stack.append([])
+        for att in attrs :
+            n.attr_set(att,attrs[att])
+
+
+
+    def end_element(self, name):
+        """This is a private function, not to be called from outside NaServer
         """
 
-        p = xml.parsers.expat.ParserCreate()
-        p.StartElementHandler = self.start_element
-        p.EndElementHandler = self.end_element
-        p.CharacterDataHandler = self.char_data
-        p.Parse(xmlrequest,1)
+        text = self.TEXT_stack.pop()
+        if (len(text) > 0):
+            self.ZAPI_stack[-1].add_content("".join(text))
+
         stack_len = len(self.ZAPI_stack)
 
-        if(stack_len <= 0):
-            return self.fail_response(13001,"Zapi::parse_xml-no elements on stack")
+        if (stack_len > 1):
+            n = self.ZAPI_stack.pop()
+            self.ZAPI_stack[-1].child_add(n)
+
+
+
+    def char_data(self, data):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        self.TEXT_stack[-1].append(data)
 
-        r = self.ZAPI_stack.pop(stack_len - 1)
 
-        return r
 
 try:
     class CustomHTTPSConnection(httplib.HTTPSConnection):
         """ Custom class to make a HTTPS connection, with support for Certificate Based Authentication"""
 
         def __init__(self, host, port, key_file, cert_file, ca_file, 
-                   need_server_auth, need_cn_verification, timeout=None):
-            httplib.HTTPSConnection.__init__(self, host, port=port, key_file=key_file, 
+                   need_server_auth, need_cn_verification, timeout=None,
+                   context=None):
+            if (context != None):
+                httplib.HTTPSConnection.__init__(self, host, port=port,
+                                     timeout=timeout, context=context)
+            else:
+                httplib.HTTPSConnection.__init__(self, host, port=port, key_file=key_file, 
                                      cert_file=cert_file,timeout=timeout)
+            self.context = context
             self.key_file = key_file
             self.cert_file = cert_file
             self.ca_file = ca_file
@@ -739,7 +1104,9 @@ try:
         def connect(self):
             sock = socket.create_connection((self.host, self.port), self.timeout)
 
-            if (self.need_server_auth == True):
+            if (self.context != None):
+                self.sock = self.context.wrap_socket(sock, server_hostname=self.host)
+            elif (self.need_server_auth == True):
                 self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file, ca_certs=self.ca_file, cert_reqs=ssl.CERT_REQUIRED)
             else:
                 self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file, ca_certs=self.ca_file)
@@ -753,3 +1120,426 @@ try:
 except AttributeError:
     pass
 
+
+
+class NaEventLoop :
+    """Runs ZAPI requests submitted with NaServer.invoke_elem_async().
+
+    All the requests are processed from a single thread using
+    non-blocking sockets, so one loop can keep many requests in
+    flight to many servers at the same time. The connections are
+    kept open (keep-alive) and reused by the next requests for the
+    same server, following the pool settings of the NaServer.
+    """
+
+
+
+    def __init__(self):
+        """Create a new event loop without requests.
+    """
+
+        self.active = []
+        self.idle = {}
+
+
+
+    def submit(self, server, data, callback, parser=None, resend=True):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        connection = self.idle_get(server)
+        if (connection == None):
+            connection = NaAsyncConnection(self, server)
+        else:
+            connection.reused = True
+        connection.request(data, callback, parser, resend)
+
+
+
+    def run(self, timeout=None):
+        """Process the requests until all of them are completed, or
+    for 'timeout' seconds at most. Callbacks can submit new requests.
+    Returns the number of requests still in progress.
+    """
+
+        deadline = None
+        if (timeout != None):
+            deadline = time.time() + timeout
+        while (len(self.active) > 0):
+            now = time.time()
+            wait = 1.0
+            if (deadline != None):
+                if (now >= deadline):
+                    break
+                wait = min(wait, deadline - now)
+            rlist = []
+            wlist = []
+            for connection in list(self.active):
+                if (connection.deadline != None):
+                    if (connection.deadline <= now):
+                        connection.fail(13001, "timed out")
+                        continue
+                    wait = min(wait, connection.deadline - now)
+                if (connection.writable()):
+                    wlist.append(connection)
+                elif (connection.readable()):
+                    rlist.append(connection)
+            if (len(rlist) == 0 and len(wlist) == 0):
+                continue
+            try:
+                (rlist, wlist, x) = select.select(rlist, wlist, [], wait)
+            except select.error:
+                if (sys.exc_info()[1].args[0] == errno.EINTR):
+                    continue
+                raise
+            for connection in wlist:
+                connection.handle_io()
+            for connection in rlist:
+                connection.handle_io()
+        return len(self.active)
+
+
+
+    def abort(self):
+        """Close the connections of the requests in progress, their
+    callbacks are not called.
+    """
+
+        active = self.active
+        self.active = []
+        for connection in active:
+            connection.close()
+
+
+
+    def close(self):
+        """Close all the connections, also the idle ones.
+    """
+
+        self.abort()
+        idle = self.idle
+        self.idle = {}
+        for connections in idle.values():
+            for (connection, last_used) in connections:
+                connection.close()
+
+
+
+    def forget(self, server):
+        """Close the idle connections of the server, to be called when
+    the server is not used any more (i.e. replaced by a new one).
+    """
+
+        for (connection, last_used) in self.idle.pop(server, []):
+            connection.close()
+
+
+
+    def idle_get(self, server):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        connections = self.idle.get(server, [])
+        now = time.time()
+        while (len(connections) > 0):
+            (connection, last_used) = connections.pop()
+            if (now - last_used <= server.pool_idle_timeout and server.is_alive(connection)):
+                return connection
+            connection.close()
+        return None
+
+
+
+    def idle_put(self, connection):
+        """This is a private function, not to be called from outside NaServer
+        """
+
+        server = connection.server
+        connections = self.idle.setdefault(server, [])
+        if (server.keep_alive and len(connections) < server.pool_size):
+            connections.append((connection, time.time()))
+        else:
+            connection.close()
+
+
+
+class NaAsyncConnection :
+    """Non-blocking HTTP(S) connection used by NaEventLoop.
+    This is a private class, not to be used from outside NaServer.
+    """
+
+    CONNECTING = 0
+    HANDSHAKE = 1
+    SENDING = 2
+    RECEIVING = 3
+    IDLE = 4
+
+
+
+    def __init__(self, loop, server):
+        self.loop = loop
+        self.server = server
+        self.sock = None
+        self.state = self.IDLE
+        self.reused = False
+        self.resend = True
+        self.want_read = False
+        self.callback = None
+        self.deadline = None
+        self.data = b""
+        self.output = b""
+        self.buffer = b""
+
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+
+    def readable(self):
+        return (self.state == self.RECEIVING or (self.state == self.HANDSHAKE and self.want_read))
+
+
+
+    def writable(self):
+        return (self.state in (self.CONNECTING, self.SENDING) or (self.state == self.HANDSHAKE and not self.want_read))
+
+
+
+    def request(self, data, callback, parser=None, resend=True):
+        self.data = data
+        self.callback = callback
+        self.response_parser = parser
+        self.resend = resend
+        self.output = data
+        self.buffer = b""
+        self.status = None
+        self.length = None
+        self.chunked = False
+        self.will_close = False
+        self.parser = None
+        if (self.server.timeout != None):
+            self.deadline = time.time() + self.server.timeout
+        else:
+            self.deadline = None
+        self.loop.active.append(self)
+        if (self.sock == None):
+            self.connect()
+        else:
+            self.state = self.SENDING
+
+
+
+    def connect(self):
+        try:
+            info = socket.getaddrinfo(self.server.server, self.server.port, 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(info[0], info[1], info[2])
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(info[4])
+        except socket.error:
+            self.fail(13001, sys.exc_info()[1])
+            return
+        if (err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK)):
+            self.fail(13001, socket.error(err, os.strerror(err)))
+            return
+        self.state = self.CONNECTING
+
+
+
+    def handle_io(self):
+        if (self.sock == None):
+            return
+        try:
+            if (self.state == self.CONNECTING):
+                err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if (err != 0):
+                    raise socket.error(err, os.strerror(err))
+                if (self.server.use_https()):
+                    self.sock = self.server.get_ssl_context().wrap_socket(self.sock,
+                        server_hostname=self.server.server, do_handshake_on_connect=False)
+                    self.state = self.HANDSHAKE
+                    self.want_read = False
+                else:
+                    self.state = self.SENDING
+            elif (self.state == self.HANDSHAKE):
+                self.handshake()
+            elif (self.state == self.SENDING):
+                sent = self.sock.send(self.output)
+                self.output = self.output[sent:]
+                if (len(self.output) == 0):
+                    self.state = self.RECEIVING
+            elif (self.state == self.RECEIVING):
+                self.receive()
+        except socket.error:
+            error = sys.exc_info()[1]
+            if (ssl_context_attr and isinstance(error, (ssl.SSLWantReadError, ssl.SSLWantWriteError))):
+                return
+            if (error.args and error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+                return
+            self.disconnected(error)
+        except xml.parsers.expat.ExpatError:
+            self.fail(13001, "Zapi::parse_xml - " + str(sys.exc_info()[1]))
+
+
+
+    def handshake(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want_read = True
+            return
+        except ssl.SSLWantWriteError:
+            self.want_read = False
+            return
+        ret = self.server.verify_ssl_socket(self.sock)
+        if (ret):
+            self.finish(ret, True)
+            return
+        self.state = self.SENDING
+
+
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                error = sys.exc_info()[1]
+                if (ssl_context_attr and isinstance(error, ssl.SSLWantReadError)):
+                    return
+                if (error.args and error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)):
+                    return
+                raise
+            if (len(data) == 0):
+                if (self.status != None and self.length == None and not self.chunked):
+                    # body delimited by the end of the connection
+                    self.will_close = True
+                    self.complete()
+                else:
+                    self.disconnected(socket.error(errno.ECONNRESET, "connection closed by the server"))
+                return
+            self.buffer = self.buffer + data
+            if (self.parse()):
+                return
+
+
+
+    def parse(self):
+        """Parse the response received so far, returns True once it is complete.
+        """
+
+        if (self.status == None):
+            pos = self.buffer.find(b"\r\n\r\n")
+            if (pos < 0):
+                return False
+            lines = self.buffer[:pos].decode("iso-8859-1").split("\r\n")
+            self.buffer = self.buffer[pos + 4:]
+            version = lines[0].split(" ", 2)
+            self.status = int(version[1])
+            headers = {}
+            for line in lines[1:]:
+                (key, sep, value) = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            connection = headers.get("connection", "").lower()
+            self.will_close = (connection == "close" or (version[0] == "HTTP/1.0" and connection != "keep-alive"))
+            if (headers.get("transfer-encoding", "").lower() == "chunked"):
+                self.chunked = True
+            elif ("content-length" in headers):
+                self.length = int(headers["content-length"])
+            if (self.status != 401):
+                self.parser = self.response_parser
+                if (self.parser == None):
+                    self.parser = NaResponseParser(self.server)
+        if (self.chunked):
+            while True:
+                if (self.length == None):
+                    pos = self.buffer.find(b"\r\n")
+                    if (pos < 0):
+                        return False
+                    size = int(self.buffer[:pos].split(b";")[0], 16)
+                    self.buffer = self.buffer[pos + 2:]
+                    if (size == 0):
+                        self.complete()
+                        return True
+                    self.length = size
+                if (len(self.buffer) < self.length + 2):
+                    return False
+                self.consume(self.buffer[:self.length])
+                self.buffer = self.buffer[self.length + 2:]
+                self.length = None
+        elif (self.length != None):
+            # the body is parsed as it arrives
+            data = self.buffer[:self.length]
+            self.buffer = self.buffer[self.length:]
+            self.length = self.length - len(data)
+            self.consume(data)
+            if (self.length == 0):
+                self.complete()
+                return True
+        else:
+            self.consume(self.buffer)
+            self.buffer = b""
+        return False
+
+
+
+    def consume(self, data):
+        if (self.parser != None and len(data) > 0):
+            self.parser.feed(data)
+
+
+
+    def complete(self):
+        if (self.status == 401):
+            self.finish(self.server.fail_response(13002, "Authorization failed"), True)
+            return
+        parser = self.parser
+        self.parser = None
+        self.finish(parser.close(), self.will_close)
+
+
+
+    def disconnected(self, error):
+        if (self.reused and self.status == None and self.data and (self.resend or len(self.output) > 0)):
+            # stale keep-alive connection, retry on a new one (not
+            # sent twice if the server may have received it)
+            self.close()
+            self.reused = False
+            self.loop.active.remove(self)
+            self.request(self.data, self.callback, self.response_parser, self.resend)
+            return
+        self.fail(13001, error)
+
+
+
+    def fail(self, errno, reason):
+        self.finish(self.server.fail_response(errno, reason), True)
+
+
+
+    def finish(self, result, close):
+        if (self in self.loop.active):
+            self.loop.active.remove(self)
+        callback = self.callback
+        self.callback = None
+        self.data = b""
+        self.reused = False
+        self.state = self.IDLE
+        if (close or self.sock == None):
+            self.close()
+        else:
+            self.loop.idle_put(self)
+        if (callback != None):
+            callback(result)
+
+
+
+    def close(self):
+        if (self.sock != None):
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.state = self.IDLE
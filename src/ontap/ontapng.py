@@ -12,18 +12,29 @@ import sys
 import time
 import re
 import unicodedata
+import xml.parsers.expat
 # import logging
 # import configobj
 import os.path
 import getopt
+import json
 import datetime
+import threading
+import Queue
 
 from collections import namedtuple as NamedTuple
 from string import Template
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    # the metrics are calculated without it (see compute_metrics)
+    numpy = None
 
 try:
     from diamond.metric import Metric
-    from diamond.collector import Collector
+    from diamond.collector import Collector, str_to_bool
 except ImportError:
     # workaround to be able to run this script as standalone program
     # Additional workaround to allow this script to act as a library
@@ -61,6 +72,16 @@ hostname_method = none
 splay = 15
 interval = 45               # sleep time
 http_timeout = 45           # timeout
+http_pool_size = 4          # keep-alive connections per device (0 = off)
+http_idle_timeout = 120     # close keep-alive connections idle for longer
+device_threads = 1          # devices collected in parallel
+object_threads = 1          # objects of a device fetched in parallel
+event_loop = False          # all devices from one thread, non-blocking
+instances_ttl = 0           # seconds the instance lists are kept (0 = off)
+info_cache_dir = /var/cache/diamond/ontap  # counter definitions (empty = off)
+instances_batch = 0         # instances per get-instances request (0 = all)
+expire_cycles = 10          # collections before removing missing instances
+heartbeat_cycles = 10       # publish unchanged |changes metrics every N cycles
 
 [devices]
 
@@ -72,6 +93,8 @@ http_timeout = 45           # timeout
     publish = 1   # 1 = publish all metrics
                   # 2 = do not publish zeros
                   # 0 = do not publish
+    object_threads = 4  # overrides the collector option for this device
+    instances_batch = 500  # also a device option
 
         #[[[na_object=pretty.path.@.${metric1}|filters]]]
         # This is the list of metrics to collect.
@@ -86,6 +109,12 @@ http_timeout = 45           # timeout
         user_writes = rate_ops_writes
         cp_reads = -
 
+        [[[volume=vservers.${vserver_name}.volumes.$instance_name]]]
+        total_ops = rate_ops
+        read_latency_hist = lat_read|percentiles  # p50, p90, p99 and max
+        size_total = size|changes       # only when it changes
+        avg_latency = latency|deadband=5%  # when it moves more than 5%
+
 ````
 
 The primary source for documentation about the API has been
@@ -104,11 +133,13 @@ class OntapClusterCollector(Collector):
         """
         # Thread safe due to the double dict structure [device][item]
         self.last_values = {}
-        self.last_collect_time = {}
         self.connections = {}
         self.reconnects = {}
         self.dev_running = {}
         self.metrics = {}
+        self.instances = {}
+        self.paths = {}
+        self.loop = None
         super(OntapClusterCollector, self).__init__(*args, **kwargs)
 
 
@@ -122,6 +153,32 @@ class OntapClusterCollector(Collector):
         config_help.update({
             'reconnect':    'Number of iterations for reconnecting',
             'http_timeout': 'Http Timeout for every connection',
+            'http_pool_size': 'Idle keep-alive connections kept per device'
+                              ' (0 disables keep-alive)',
+            'http_idle_timeout': 'Seconds an idle keep-alive connection'
+                                 ' is kept open',
+            'device_threads': 'Number of devices collected in parallel'
+                              ' (1 = sequential)',
+            'object_threads': 'Number of objects of a device fetched in'
+                              ' parallel, also a device option',
+            'event_loop':   'Collect all devices from one thread with non-'
+                            'blocking requests, instead of device_threads',
+            'instances_ttl': 'Seconds the instance list of an object is'
+                             ' reused before getting it again (0 = every'
+                             ' collection)',
+            'info_cache_dir': 'Directory to keep the counter definitions of'
+                              ' each device for its ONTAP version (empty ='
+                              ' get them on every start)',
+            'instances_batch': 'Maximum number of instances of an object in'
+                               ' each request for its values (0 = all),'
+                               ' also a device option',
+            'expire_cycles': 'Collections of an object without an instance'
+                             ' before its last values are removed (0 ='
+                             ' never)',
+            'heartbeat_cycles': 'Collections after which the metrics with'
+                                ' |changes or |deadband are published even'
+                                ' if they did not change (0 = never), also'
+                                ' a device option',
             'path_prefix':  'Prefix for device.instance.metric',
             'interval':     'Interval',
         })
@@ -141,6 +198,16 @@ class OntapClusterCollector(Collector):
             'hostname_method':  'none',
             'interval':         60,
             'http_timeout':     30,
+            'http_pool_size':   4,
+            'http_idle_timeout': 120,
+            'device_threads':   1,
+            'object_threads':   1,
+            'event_loop':       False,
+            'instances_ttl':    0,
+            'info_cache_dir':   '',
+            'instances_batch':  0,
+            'expire_cycles':    10,
+            'heartbeat_cycles': 10,
             'measure_collector_time': False
         })
         return default_config
@@ -169,6 +236,21 @@ class OntapClusterCollector(Collector):
                     server = NetAppMetrics(
                         c['ip'], c['user'], c['password'], c['apiversion'],
                         self.config['http_timeout'])
+                    pool_size = int(self.config['http_pool_size'])
+                    server.set_keep_alive(
+                        pool_size > 0, pool_size,
+                        float(self.config['http_idle_timeout']))
+                    if device in self.connections:
+                        old = self.connections[device]
+                        # its iterators are not known by the new one
+                        try:
+                            self._close_iterators(device, old)
+                        except Exception as e:
+                            self.log.error(str(e))
+                        old.close()
+                        if self.loop is not None:
+                            # its idle connections in the event loop
+                            self.loop.forget(old.server)
                     self.reconnects[device] = int(self.config['reconnect'])
                     self.connections[device] = server
                 except (KeyError, ValueError) as e:
@@ -191,9 +273,52 @@ class OntapClusterCollector(Collector):
             label: new label of the metric
             publish: True if it will be published
 
-        Returns a tuple with: (pretty, unit, prop, base, priv, publish)
+        The label can be followed by modes separated by '|':
+            percentiles: for histograms, whose buckets are labeled with
+                their bounds (<20us, <40us, ...), only the percentiles of
+                the increments of the buckets are published (see
+                histogram_summary), with the label (or the metric) as
+                prefix. 'summary' is (prefix, bounds of the buckets).
+            changes: the values are only published when they change, or
+                every 'heartbeat_cycles' collections.
+            deadband=N or deadband=N%: like changes, but only when they
+                move more than N, or N% of the last value published.
+                'deadband' is (N, False) or (N / 100, True), (0, False)
+                for changes.
+
+        Returns a tuple with:
+            (pretty, unit, prop, base, priv, publish, summary, deadband)
         """
         (unit, prop, base, priv, desc, labels) = info_metrics[metric]
+        summary = None
+        deadband = None
+        if isinstance(label, basestring) and '|' in label:
+            modes = label.split('|')
+            label = modes.pop(0).strip()
+            name = metric if label == '' or label == '-' else label
+            for mode in modes:
+                mode = mode.strip()
+                if mode == 'percentiles':
+                    bounds = histogram_bounds(labels)
+                    if bounds:
+                        summary = (name, bounds)
+                        label = '-'
+                        continue
+                elif mode == 'changes':
+                    deadband = (0.0, False)
+                    continue
+                elif mode.startswith('deadband='):
+                    band = mode[len('deadband='):].strip()
+                    try:
+                        if band.endswith('%'):
+                            deadband = (float(band[:-1]) / 100.0, True)
+                        else:
+                            deadband = (float(band), False)
+                        continue
+                    except ValueError:
+                        pass
+                msg = "Metric '%s' on '%s' cannot be published as '%s'!"
+                self.log.warning(msg, metric, device, mode)
         if prop.startswith('raw'):
             prop_type = 1
         elif prop.startswith('rate'):
@@ -227,7 +352,8 @@ class OntapClusterCollector(Collector):
                 pretty = labels
         else:
             pretty = [label]
-        return (pretty, unit, prop_type, base, priv, publish)
+        return (pretty, unit, prop_type, base, priv, publish, summary,
+                deadband)
 
 
     def get_metrics(self, device, server):
@@ -242,9 +368,12 @@ class OntapClusterCollector(Collector):
         match_var = re.compile(r'\$([\w_-]+)')
         match_var_b = re.compile(r'\${([\w_-]+)}')
         metrics = {}
+        paths = {}
         counter_metrics = 0
         self.log.info("Parsing metrics for '%s'", device)
         conf = self.config['devices'][device]
+        info = self._load_info(device, server)
+        info_changed = False
         for cobject in conf.keys():
             cobj_metrics = conf[cobject]
             if not isinstance(cobj_metrics, dict):
@@ -267,12 +396,17 @@ class OntapClusterCollector(Collector):
                 na_object_filter
             )
             # Get all metrics from the object
-            try:
-                info_metrics = server.get_info(na_object_name)
-            except ValueError as e:
-                msg = "'%s' metrics for '%s': %s"
-                self.log.error(msg, na_object_name, device, str(e))
-                continue
+            if na_object_name in info:
+                info_metrics = info[na_object_name]
+            else:
+                try:
+                    info_metrics = server.get_info(na_object_name)
+                except ValueError as e:
+                    msg = "'%s' metrics for '%s': %s"
+                    self.log.error(msg, na_object_name, device, str(e))
+                    continue
+                info[na_object_name] = info_metrics
+                info_changed = True
             obj_metrics = {}
             base_metrics = []
             for metric in cobj_metrics.keys():
@@ -281,21 +415,20 @@ class OntapClusterCollector(Collector):
                     self.log.error(msg, metric, device)
                     continue
                 try:
-                    (pretty, unit, prop, base, priv, publish) = \
-                        self.__get_metric(
-                            device,
-                            metric,
-                            info_metrics,
-                            cobj_metrics[metric],
-                            True
-                        )
+                    obj_metrics[metric] = self.__get_metric(
+                        device,
+                        metric,
+                        info_metrics,
+                        cobj_metrics[metric],
+                        True
+                    )
                 except:
                     msg = "Not found metric '%s' for '%s'"
                     self.log.error(msg, metric, device)
                     continue
+                base = obj_metrics[metric][3]
                 if base:
                     base_metrics.append(base)
-                obj_metrics[metric] = (pretty, unit, prop, base, priv, publish)
                 counter_metrics += 1
             # Ref base metris
             for metric in base_metrics:
@@ -328,11 +461,82 @@ class OntapClusterCollector(Collector):
                         msg = "Not found metric '%s' for '%s'"
                         self.log.error(msg, metric, device)
             metrics[na_object] = obj_metrics
+            paths[na_object] = PrettyPath(na_object.pretty)
+        if info_changed:
+            self._save_info(device, server, info)
         self.metrics[device] = metrics
+        self.paths[device] = paths
         self.log.info("%d metrics for '%s'", counter_metrics, device)
         return counter_metrics
 
 
+    def _info_file(self, device):
+        """Gets the file with the counter definitions of the device.
+
+        Returns the path or None if 'info_cache_dir' is not defined.
+        """
+        directory = self.config['info_cache_dir']
+        if not directory:
+            return None
+        name = re.sub(r'[^\w.-]', '_', device)
+        return os.path.join(directory, name + '.json')
+
+
+    def _info_key(self, server):
+        """Returns what identifies the device and its ONTAP version."""
+        return [server.device, server.clustered,
+                server.generation, server.major, server.minor]
+
+
+    def _load_info(self, device, server):
+        """Loads the counter definitions (from get_info) of the objects of
+        the device saved by _save_info, only if they were saved for the
+        same address and ONTAP version.
+
+        Returns a dict with the object names as keys.
+        """
+        path = self._info_file(device)
+        if path is None or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as cache:
+                data = json.load(cache)
+        except (IOError, OSError, ValueError) as e:
+            self.log.warning("Cannot read '%s': %s", path, str(e))
+            return {}
+        if data.get('key') != self._info_key(server):
+            self.log.info("Ignoring '%s', ONTAP version changed", path)
+            return {}
+        info = {}
+        for name, counters in data.get('objects', {}).iteritems():
+            info[name] = dict(
+                (counter, tuple(values))
+                for counter, values in counters.iteritems())
+        self.log.debug("Counter definitions of '%s' from '%s'", device, path)
+        return info
+
+
+    def _save_info(self, device, server, info):
+        """Saves the counter definitions of the objects of the device with
+        its address and ONTAP version, if 'info_cache_dir' is defined.
+        """
+        path = self._info_file(device)
+        if path is None:
+            return
+        data = {'key': self._info_key(server), 'objects': info}
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # other processes only see the complete file
+            tmp_path = '%s.%d' % (path, os.getpid())
+            with open(tmp_path, 'w') as cache:
+                json.dump(data, cache)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            self.log.warning("Cannot write '%s': %s", path, str(e))
+
+
     def process_config(self):
         """Process the configuration to enable/disable devices.
 
@@ -345,9 +549,10 @@ class OntapClusterCollector(Collector):
         if 'devices' in self.config:
             for device in self.config['devices']:
                 if device not in self.dev_running:
-                    self.last_collect_time[device] = {}
                     self.last_values[device] = {}
                     self.dev_running[device] = False
+                # objects (or their filters) can be different now
+                self.instances[device] = {}
                 try:
                     server = self._connect(device)
                     self.get_metrics(device, server)
@@ -378,10 +583,14 @@ class OntapClusterCollector(Collector):
                     deleted.append(device)
             for device in deleted:
                 del self.dev_running[device]
-                del self.last_collect_time[device]
                 del self.last_values[device]
                 del self.metrics[device]
-                del self.connections[device]
+                del self.paths[device]
+                del self.instances[device]
+                self.connections.pop(device).close()
+                if self.loop is not None:
+                    self.loop.close()
+                    self.loop = None
                 del self.reconnects[device]
                 self.log.info("Deleted device: '%s'", device)
         else:
@@ -393,12 +602,16 @@ class OntapClusterCollector(Collector):
         """Collects the metrics.
 
         Diamond calls this funtion to collect the metrics. Starting on Diamond
-        v4.0 due to the changes in the threading model, only sequencial device
-        processingis possible. Now, the way to go is by creating different
-        configuration files, one per NetApp device and Diamond will schedule
-        each one in a different process.
+        v4.0 due to the changes in the threading model, each collector runs
+        in a single process. Devices are processed sequentially unless
+        'device_threads' is greater than 1: then a pool of worker threads
+        collects the devices in parallel, and this function only waits up to
+        'interval' seconds for them. A device still running when the next
+        collection starts is skipped (see 'dev_running') until it finishes.
+        With 'event_loop', all the devices are collected by _collect_loop.
         """
         interval = int(self.config['interval'])
+        devices = []
         for device in self.config['devices']:
             if self.dev_running[device]:
                 self.log.error(
@@ -407,21 +620,227 @@ class OntapClusterCollector(Collector):
                     device,
                     self.config['http_timeout']
                 )
-                return
+                continue
             self.dev_running[device] = True
-            self.log.info("Starting metrics collection for '%s'", device)
-            try:
-                publish = int(self.config['devices'][device]['publish'])
-                records = self.collect_device( device, interval, publish)
-            except Exception as e:
-                self.log.error(str(e))
-                records = 0
-            self.log.info(
-                "End collection for '%s' (%i metrics processed)",
-                device,
-                records
+            devices.append(device)
+        if str_to_bool(self.config['event_loop']):
+            self._collect_loop(devices, interval)
+            return
+        threads = min(int(self.config['device_threads']), len(devices))
+        if threads <= 1:
+            for device in devices:
+                self._collect_device(device, interval)
+            return
+        queue = Queue.Queue()
+        for device in devices:
+            queue.put(device)
+        workers = []
+        for i in range(threads):
+            worker = threading.Thread(
+                target=self._collect_worker,
+                args=(queue, interval),
+                name="%s-%i" % (self.__class__.__name__, i)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        deadline = time.time() + interval
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+        running = [d for d in devices if self.dev_running[d]]
+        if running:
+            self.log.warning(
+                "Collection not finished after %is for: %s",
+                interval,
+                ', '.join(running)
             )
-            self.dev_running[device] = False
+
+
+    def _collect_loop(self, devices, interval):
+        """Collects the devices from this thread using an event loop.
+
+        All the requests to all the devices are sent without blocking by
+        a NaServer.NaEventLoop, up to 'object_threads' objects per device
+        at the same time, and each object (or batch of its instances) is
+        processed when its values arrive. The requests still running after
+        'interval' seconds are aborted.
+        """
+        if self.loop is None:
+            self.loop = NaServer.NaEventLoop()
+        records = {}
+        publish = {}
+        servers = {}
+        finished = False
+        try:
+            for device in devices:
+                self.log.info("Starting metrics collection for '%s'", device)
+                records[device] = 0
+                try:
+                    publish[device] = int(
+                        self.config['devices'][device]['publish'])
+                    server = self._connect(device)
+                    servers[device] = server
+                    self._close_iterators(device, server)
+                    # not there if get_metrics failed in process_config
+                    objects = self.metrics[device].items()
+                except Exception as e:
+                    self.log.error(str(e))
+                    publish.pop(device, None)
+                    continue
+                threads = max(1, self._object_threads(device))
+                for i in range(min(threads, len(objects))):
+                    self._loop_fetch(
+                        device, server, objects, interval, publish[device],
+                        records)
+            if self.loop.run(interval):
+                self.log.warning(
+                    "Collection not finished after %is, aborted", interval)
+                self.loop.abort()
+            finished = True
+        finally:
+            if not finished:
+                # the loop failed, its requests are dropped and the
+                # iterators they left open are ended now
+                self.loop.abort()
+                for device, server in servers.items():
+                    try:
+                        self._close_iterators(device, server)
+                    except Exception as e:
+                        self.log.error(str(e))
+            for device in devices:
+                if finished and device in publish:
+                    try:
+                        self._expire_values(device, publish[device])
+                    except Exception as e:
+                        self.log.error(str(e))
+                self.log.info(
+                    "End collection for '%s' (%i metrics processed)",
+                    device,
+                    records.get(device, 0)
+                )
+                self.dev_running[device] = False
+
+
+    def _loop_fetch(self, device, server, objects, interval, publish,
+                    records):
+        """Fetches the next object of a device on the event loop.
+
+        The values of each batch of instances (see instances_batch) are
+        processed when they arrive and then the next batch is fetched, and
+        then the next object in 'objects', until the list is empty.
+        """
+        if not objects:
+            return
+        na_object, metrics = objects.pop()
+        batches = []
+        state = {'cached': False}
+
+        def next_object():
+            self._loop_fetch(
+                device, server, objects, interval, publish, records)
+
+        def next_batch():
+            if not batches:
+                next_object()
+                return
+            batch = batches.pop(0)
+            server.get_metrics_async(
+                self.loop, na_object.name, batch, metrics.keys(),
+                lambda result, error: got_metrics(batch, result, error))
+
+        def got_metrics(batch, result, error):
+            if error is not None:
+                if state['cached'] and isinstance(error, ValueError):
+                    # maybe some of the cached instances do not exist
+                    state['cached'] = False
+                    self._drop_instances(device, na_object)
+                    server.get_instances_async(
+                        self.loop, na_object.name, na_object.filter,
+                        lambda got, error: got_instances(got, error, batch))
+                    return
+                self.log.error(str(error))
+            else:
+                if state['cached'] and len(result[0]) < len(batch):
+                    self._refresh_instances(device, server, na_object, True)
+                try:
+                    records[device] += self._process_object(
+                        device, na_object, metrics, result, interval, publish)
+                except Exception as e:
+                    self.log.error(str(e))
+            next_batch()
+
+        def got_instances(instances, error, failed=None):
+            if error is not None:
+                self.log.error(str(error))
+            elif not instances:
+                self.log.error(
+                    "No metrics '%s' with filter '%s' on %s",
+                    na_object.name,
+                    na_object.filter,
+                    device
+                )
+            else:
+                if not state['cached']:
+                    self._cache_instances(device, na_object, instances)
+                if failed is None:
+                    batches.extend(self._batches(device, instances))
+                else:
+                    # the failed batch and the next ones, without the
+                    # instances which do not exist anymore
+                    current = set(instances)
+                    pending = [failed] + batches
+                    del batches[:]
+                    for batch in pending:
+                        batch = [i for i in batch if i in current]
+                        if batch:
+                            batches.append(batch)
+                next_batch()
+                return
+            next_object()
+
+        # the instances are only requested if they are not cached
+        cached, refresh = self._cached_instances(device, na_object)
+        state['cached'] = bool(cached)
+        if refresh:
+            self._refresh_instances(device, server, na_object, True)
+        if cached:
+            got_instances(cached, None)
+        else:
+            server.get_instances_async(
+                self.loop, na_object.name, na_object.filter, got_instances)
+
+
+    def _collect_worker(self, queue, interval):
+        """Worker thread for collect(), processes devices from the queue.
+        """
+        while True:
+            try:
+                device = queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._collect_device(device, interval)
+
+
+    def _collect_device(self, device, interval):
+        """Collects one device and logs the result.
+
+        The device has to be flagged in 'dev_running' by the caller, this
+        function clears the flag when it finishes.
+        """
+        self.log.info("Starting metrics collection for '%s'", device)
+        try:
+            publish = int(self.config['devices'][device]['publish'])
+            records = self.collect_device(device, interval, publish)
+            self._expire_values(device, publish)
+        except Exception as e:
+            self.log.error(str(e))
+            records = 0
+        self.log.info(
+            "End collection for '%s' (%i metrics processed)",
+            device,
+            records
+        )
+        self.dev_running[device] = False
 
 
     def collect_device(self, device, interval, publish):
@@ -429,323 +848,635 @@ class OntapClusterCollector(Collector):
 
         Returns the number of metrics processed.
         """
-        max_interval = interval + interval * 0.5
         total_records = 0
         server = self._connect(device)
-        # We're only able to query a single object at a time,
-        # so we'll loop over the objects.
-        for na_object, metrics in self.metrics[device].iteritems():
+        self._close_iterators(device, server)
+        # We're only able to query a single object at a time, the
+        # objects are fetched by _fetch_objects (maybe in parallel, and
+        # in batches of instances) and processed here as soon as each
+        # one is available.
+        for na_object, metrics, result in self._fetch_objects(device, server):
             # na_object.name
             # na_object.pretty
             # na_object.filter
+            if result is None:
+                continue
+            total_records += self._process_object(
+                device, na_object, metrics, result, interval, publish)
+        return total_records
+
+
+    def _expire_values(self, device, publish):
+        """Removes the last values of the instances missing in the last
+        'expire_cycles' collections of their objects, and of the objects
+        not in the configuration anymore.
+
+        Publishes the number of series (values of the counters of the
+        instances) kept and of instances removed as collector.series and
+        collector.evicted of the device.
+        """
+        cycles = int(self.config['expire_cycles'])
+        series = 0
+        evicted = 0
+        states = self.last_values[device]
+        for na_object, state in states.items():
+            pretty_path = self.paths[device].get(na_object)
+            if pretty_path is None:
+                evicted += len(state.rows)
+                del states[na_object]
+                continue
+            removed = state.expire(cycles)
+            if removed:
+                pretty_path.expire(state.rows)
+                evicted += removed
+            series += state.series()
+        if evicted:
+            self.log.info(
+                "Removed the values of %i instances of '%s'", evicted, device)
+        if publish == 0:
+            return
+        values = []
+        for name, value in (('series', series), ('evicted', evicted)):
+            if value == 0 and publish == 2:
+                continue
+            path = self.get_metric_path('collector.' + name, device)
+            values.append((path, value))
+        self.publish_values(device, values, 0)
+
+
+    def _close_iterators(self, device, server):
+        """Ends the ZAPI iterators left open on the device by the previous
+        collection (when it was aborted or it failed) and logs them.
+        """
+        leaked = server.open_iterators()
+        if not leaked:
+            return
+        for tag, api, age in leaked:
+            self.log.warning(
+                "Iterator '%s' (%s) left open on '%s' %is ago",
+                tag, api, device, age)
+        for tag, api, age in server.close_iterators():
+            self.log.error(
+                "Cannot end iterator '%s' (%s) on '%s'", tag, api, device)
+
+
+    def _process_object(self, device, na_object, metrics, result, interval,
+                        publish):
+        """Processes and publishes the values of an object of the device.
+
+        Returns the number of metrics processed.
+        """
+        max_interval = interval + interval * 0.5
+        values, times, instance_t = result
+        # Process the records
+        records_counter = 0
+        pretty_path = self.paths[device][na_object]
+        state = self.last_values[device].get(na_object)
+        if state is None:
+            state = ObjectValues()
+            self.last_values[device][na_object] = state
+        batch = MetricBatch()
+        for instance, data in values.iteritems():
             try:
-                instances = server.get_instances(
-                    na_object.name, na_object.filter)
-                if instances:
-                    values, times, instance_t = server.get_metrics(
-                        na_object.name, instances, metrics.keys())
-                else:
-                    self.log.error(
-                        "No metrics '%s' with filter '%s' on %s",
-                        na_object.name,
-                        na_object.filter,
-                        device
+                metrics_path, paths = pretty_path.get(device, instance, data)
+            except Exception as e:
+                self.log.error(
+                    "Cannot build metric name '%s' on '%s': %s",
+                    na_object.pretty,
+                    device,
+                    str(e)
+                )
+                continue
+            # time delta
+            row = state.row(metrics_path)
+            if row in batch.seen:
+                # same metric path than another instance, its values have
+                # to be the last ones for this one
+                records_counter += self._publish_batch(
+                    device, batch, state, publish)
+                batch = MetricBatch()
+            old_time = state.get_time(row)
+            if old_time is None:
+                time_delta = 0
+            else:
+                time_delta = instance_t - old_time
+                if time_delta <= 0:
+                    self.log.warning(
+                        "**time-delta <= 0s** for %s (from the API)!",
+                        metrics_path
+                    )
+                    time_delta = times[instance] - old_time
+                if max_interval < time_delta:
+                    self.log.warning(
+                        "**too much time** between collects '%s': %s s",
+                        metrics_path, time_delta
                     )
+            state.set_time(row, instance_t)
+            #state.set_time(row, times[instance])
+
+            # process all metrics
+            self._add_metrics(
+                batch, metrics_path, data, time_delta, metrics, state, row,
+                paths)
+        records_counter += self._publish_batch(device, batch, state, publish)
+        # control the number of records
+        if records_counter == 0:
+            self.log.error(
+                "No instances for object '%s' on '%s'",
+                na_object,
+                device
+            )
+        return records_counter
+
+
+    def _object_threads(self, device):
+        """Returns the number of objects of a device to fetch in parallel.
+        """
+        try:
+            return int(self.config['devices'][device]['object_threads'])
+        except KeyError:
+            return int(self.config['object_threads'])
+
+
+    def _instances_batch(self, device):
+        """Returns the maximum number of instances of an object of a device
+        to get in each request, 0 means all of them.
+        """
+        try:
+            return int(self.config['devices'][device]['instances_batch'])
+        except KeyError:
+            return int(self.config['instances_batch'])
+
+
+    def _heartbeat_cycles(self, device):
+        """Returns the number of collections after which the metrics
+        published only when they change are published anyway (0 = never).
+        """
+        try:
+            return int(self.config['devices'][device]['heartbeat_cycles'])
+        except KeyError:
+            return int(self.config['heartbeat_cycles'])
+
+
+    def _batches(self, device, instances):
+        """Splits the instances of an object in batches of 'instances_batch'
+        (device option, or the collector one by default).
+
+        Returns a list of lists of instances.
+        """
+        size = self._instances_batch(device)
+        if size <= 0 or len(instances) <= size:
+            return [instances]
+        return [instances[i:i + size] for i in range(0, len(instances), size)]
+
+
+    def _fetch_objects(self, device, server):
+        """Gets the values of all the objects of a device.
+
+        The instances of each object are split in batches (see _batches)
+        which are fetched sequentially, or in parallel by up to
+        'object_threads' worker threads (device option, or the collector
+        one by default).
+
+        Yields a tuple (na_object, metrics, result) for each batch of each
+        object (for each page of it in sequential mode), in the order they
+        are fetched, see _fetch_batch for the result. The next batches are
+        not fetched until the previous ones are taken, so only a few of
+        them are kept in memory.
+        """
+        objects = self.metrics[device].items()
+        threads = self._object_threads(device)
+        if self._instances_batch(device) <= 0:
+            threads = min(threads, len(objects))
+        if threads <= 1:
+            for na_object, metrics in objects:
+                instances, cached = self._fetch_instances(
+                    device, server, na_object)
+                if not instances:
                     continue
-            except IOError as e:
-                self.log.error("Cannot connect to '%s': %s", device, str(e))
-                continue
-            # Process the records
-            records_counter = 0
-            for instance, data in values.iteritems():
-                metrics_path = device
-                for item in na_object.pretty.split('.'):
-                    try:
-                        item = item.replace('@', instance)
-                        mtemplate = Template(item)
-                        item = mtemplate.safe_substitute(data)
-                        item = item.replace('.', '_').strip('_')
-                        item = item.replace('/', '.').strip('.')
-                        metrics_path += '.' + re.sub(
-                            r'[^a-zA-Z0-9._]',
-                            '_',
-                            item
-                        )
-                    except Exception as e:
-                        self.log.error(
-                            "Cannot build metric name '%s' on '%s': %s",
-                            na_object.pretty,
-                            device,
-                            str(e)
-                        )
-                # time delta
+                for batch in self._batches(device, instances):
+                    for result in self._fetch_batch(
+                            device, server, na_object, metrics, batch, cached):
+                        yield (na_object, metrics, result)
+            return
+        # items: (na_object, metrics, batch, cached), with batch None the
+        # instances are requested and the other batches put in the queue
+        pending = Queue.Queue()
+        for na_object, metrics in objects:
+            pending.put((na_object, metrics, None, False))
+        done = Queue.Queue(threads)
+        stop = threading.Event()
+        # results not taken yet, the workers add the batches they queue
+        remaining = [len(objects)]
+        lock = threading.Lock()
+
+        def give(item):
+            while not stop.is_set():
                 try:
-                    old_time = self.last_collect_time[device][metrics_path]
-                except:
-                    time_delta = 0
-                else:
-                    time_delta = instance_t - old_time
-                    if time_delta <= 0:
-                        self.log.warning(
-                            "**time-delta <= 0s** for %s (from the API)!",
-                            metrics_path
-                        )
-                        time_delta = times[instance] - old_time
-                    if max_interval < time_delta:
-                        self.log.warning(
-                            "**too much time** between collects '%s': %s s",
-                            metrics_path, time_delta
-                        )
-                self.last_collect_time[device][metrics_path] = instance_t
-                #self.last_collect_time[device][metrics_path] = \
-                #   times[instance]
-
-                # process all metrics
-                records_counter += self._publish_metrics(
-                    device, instance, metrics_path,
-                    data, time_delta, metrics, publish)
-            # control the number of records
-            if records_counter == 0:
+                    done.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def worker():
+            while not stop.is_set():
+                item = pending.get()
+                if item is None:
+                    return
+                na_object, metrics, batch, cached = item
+                try:
+                    if batch is None:
+                        instances, cached = self._fetch_instances(
+                            device, server, na_object)
+                        if instances:
+                            batches = self._batches(device, instances)
+                            batch = batches.pop(0)
+                            with lock:
+                                remaining[0] += len(batches)
+                            for other in batches:
+                                pending.put(
+                                    (na_object, metrics, other, cached))
+                    result = []
+                    if batch:
+                        result = list(self._fetch_batch(
+                            device, server, na_object, metrics, batch, cached))
+                except Exception as e:
+                    result = e
+                give((na_object, metrics, result))
+
+        for i in range(threads):
+            thread = threading.Thread(
+                target=worker, name="%s-%i" % (device, i))
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        break
+                    remaining[0] -= 1
+                na_object, metrics, result = done.get()
+                if isinstance(result, Exception):
+                    raise result
+                for page in result:
+                    yield (na_object, metrics, page)
+        finally:
+            stop.set()
+            for i in range(threads):
+                pending.put(None)
+
+
+    def _fetch_instances(self, device, server, na_object):
+        """Gets the instances of an object from the cache (see
+        _cached_instances) or from the device.
+
+        Returns the tuple (instances, cached), instances is None or empty
+        if there are no instances or the device is not reachable.
+        """
+        try:
+            instances, refresh = self._cached_instances(device, na_object)
+            if refresh:
+                self._refresh_instances(device, server, na_object)
+            if instances:
+                return instances, True
+            instances = server.get_instances(
+                na_object.name, na_object.filter)
+            self._cache_instances(device, na_object, instances)
+            if not instances:
                 self.log.error(
-                    "No instances for object '%s' on '%s'",
-                    na_object,
+                    "No metrics '%s' with filter '%s' on %s",
+                    na_object.name,
+                    na_object.filter,
                     device
                 )
-            total_records += records_counter
-        return total_records
+            return instances, False
+        except IOError as e:
+            self.log.error("Cannot connect to '%s': %s", device, str(e))
+        return None, False
 
 
-    def _publish_metrics(self, device, instance, metrics_path, data,
-                         time_delta, metrics, publish):
-        """Process and publish all metrics for an object.
-        If a value is an array, it will process each value.
+    def _fetch_batch(self, device, server, na_object, metrics, instances,
+                     cached):
+        """Gets the values of some instances of an object from the device.
 
-        Returns  number of processed metrics
+        Yields the tuples (values, times, instance_t) from iter_metrics as
+        they are received, nothing if the device is not reachable.
         """
-        counter = 0
-        processed_values = {}
-        for metric in metrics.keys():
-            path = self.get_metric_path(metric, metrics_path)
-            (pretty, unit, prop, base, priv, publish_metric) = metrics[metric]
+        count = 0
+        try:
+            try:
+                for result in server.iter_metrics(
+                        na_object.name, instances, metrics.keys()):
+                    count += len(result[0])
+                    yield result
+            except ValueError:
+                if not cached or count > 0:
+                    raise
+                # maybe some of the cached instances do not exist
+                self._drop_instances(device, na_object)
+                current, cached = self._fetch_instances(
+                    device, server, na_object)
+                current = set(current or [])
+                instances = [i for i in instances if i in current]
+                if instances:
+                    for result in self._fetch_batch(
+                            device, server, na_object, metrics, instances,
+                            False):
+                        yield result
+                return
+            if cached and count < len(instances):
+                self._refresh_instances(device, server, na_object)
+        except IOError as e:
+            self.log.error("Cannot connect to '%s': %s", device, str(e))
+
+
+    def _cached_instances(self, device, na_object):
+        """Gets the instances of an object of the device kept by
+        _cache_instances, which are reused during 'instances_ttl' seconds.
+
+        Returns the tuple (instances, refresh), instances is None if they
+        are not cached and refresh is True when they are older than
+        'instances_ttl' and they have to be refreshed (once).
+        """
+        entry = self.instances.get(device, {}).get(na_object)
+        if entry is None:
+            return None, False
+        instances, expires, refreshing = entry
+        if refreshing or time.time() < expires:
+            return instances, False
+        entry[2] = True
+        return instances, True
+
+
+    def _cache_instances(self, device, na_object, instances):
+        """Keeps the instances of an object of the device for 'instances_ttl'
+        seconds (if it is not 0).
+        """
+        ttl = float(self.config['instances_ttl'])
+        cache = self.instances.get(device)
+        if ttl > 0 and instances and cache is not None:
+            cache[na_object] = [instances, time.time() + ttl, False]
+
+
+    def _drop_instances(self, device, na_object):
+        """Forgets the cached instances of an object of the device, they will
+        be requested again in the next fetch.
+        """
+        self.instances.get(device, {}).pop(na_object, None)
+
+
+    def _refresh_instances(self, device, server, na_object, loop=False):
+        """Gets again the instances of an object of the device in background,
+        from a new thread or on the event loop, while the cached ones are
+        still used.
+        """
+        entry = self.instances.get(device, {}).get(na_object)
+        if entry is not None:
+            entry[2] = True
+
+        def refreshed(instances, error):
+            if error is not None:
+                msg = "Cannot refresh instances of '%s' on %s: %s"
+                self.log.error(msg, na_object.name, device, str(error))
+            if instances:
+                self._cache_instances(device, na_object, instances)
+            else:
+                self._drop_instances(device, na_object)
+
+        def refresh():
+            try:
+                instances = server.get_instances(
+                    na_object.name, na_object.filter)
+            except Exception as e:
+                refreshed(None, e)
+            else:
+                refreshed(instances, None)
+
+        if loop:
+            server.get_instances_async(
+                self.loop, na_object.name, na_object.filter, refreshed)
+        else:
+            thread = threading.Thread(target=refresh)
+            thread.daemon = True
+            thread.start()
+
+
+    def _add_metrics(self, batch, metrics_path, data, time_delta, metrics,
+                     state, row, paths=None):
+        """Adds the metrics of an instance to the batch of its object.
+        If a value is an array, it will add each value.
+
+        The previous values are in the 'row' of the instance in 'state'
+        (the ObjectValues of the object).
+
+        The metric paths are kept in 'paths' (by metric or label name)
+        to be reused while 'metrics_path' does not change.
+        """
+        if paths is None:
+            paths = {}
+        index = batch.instance(row, time_delta, metrics_path, paths)
+        counters = batch.counters
+        for metric, (pretty, unit, prop, base, priv, publish_metric,
+                     summary, deadband) in metrics.iteritems():
             # if pretty is None, it will not be published
             if pretty is None:
                 continue
             try:
                 value = data[metric]
             except:
-                self.log.error("Metric '%s' was not collected!", path)
+                self.log.error(
+                    "Metric '%s' was not collected!",
+                    self._metric_path(paths, metric, metrics_path))
                 continue
-            # Is it an array?
-            value_list = []
-            counter_key = 0
-            for thing in value.split(','):
-                try:
-                    item = float(thing)
-                except:
-                    self.log.error("Metric '%s' not a number!", path)
-                    break
+            # Is it an array? All the values are converted at once, one
+            # by one only to find the first one which is not a number.
+            things = value.split(',')
+            try:
+                items = map(float, things)
+            except ValueError:
+                items = []
+                for thing in things:
+                    try:
+                        items.append(float(thing))
+                    except ValueError:
+                        self.log.error(
+                            "Metric '%s' not a number!",
+                            self._metric_path(paths, metric, metrics_path))
+                        break
+            ref_value = 0.0
+            if prop == 4 or prop == 5:
+                # average or percent, the base metric of this instance
                 try:
-                    key = pretty[counter_key]
+                    ref_value = float(data[base])
+                except KeyError:
+                    self.log.error(
+                        "Metric '%s' was not collected!",
+                        self._metric_path(paths, base, metrics_path))
+                    continue
                 except:
-                    key = metric + '_' + str(counter_key)
-                value_list.append((key, item))
-                counter_key += 1
-            for name, value in value_list:
-                pretty_path = self.get_metric_path(name, metrics_path)
-                if prop == 1:   # raw
-                    # As it was collected
-                    result = self.raw_metric(pretty_path, value)
-                elif prop == 2:  # rate
-                    # metric - metric' / time
-                    result = self.derivative_metric(
-                        pretty_path,
-                        value,
-                        device,
-                        True,
-                        time_delta
-                    )
-                elif prop == 3:  # delta
-                    # metric - metric'
-                    result = self.derivative_metric(
-                        pretty_path,
-                        value,
-                        device,
-                        False
-                    )
-                elif prop == 4:  # average
-                    # (metric - metric') / (ref_metric - ref_metric')
-                    try:
-                        result = self._calc_derivative_refmetric(
-                            pretty_path,
-                            value,
-                            1.0,
-                            base,
-                            data,
-                            metrics,
-                            device,
-                            metrics_path
-                        )
-                    except ValueError as e:
-                        self.log.error(str(e))
-                        continue
-                elif prop == 5:   # percent
-                    # 100 * (metric - metric') / (ref_metric - ref_metric')
-                    try:
-                        result = self._calc_derivative_refmetric(
-                            pretty_path, value, 100.0, base, data,
-                            metrics, device, metrics_path)
-                    except ValueError as e:
-                        self.log.error(str(e))
-                        continue
-                else:
-                    publish_metric = False
-                processed_values[pretty_path] = value
-                counter += 1
-                # Publish the metrics
-                if publish_metric:
-                    if result == 0.0 and publish == 2:
-                        self.log.debug(
-                            "Metric '%s' == 0.0 not published",
-                            pretty_path
-                        )
-                    else:
-                        self.publish_metric(Metric(
-                            pretty_path, result, precision=4, host=device))
-                else:
-                    msg = "Metric '%s' not requested to be published"
-                    self.log.debug(msg, pretty_path)
-        # Move current values to last values
-        self.last_values[device].update(processed_values)
-        processed_values = {}
+                    self.log.error(
+                        "Metric '%s' is not a float number!",
+                        self._metric_path(paths, base, metrics_path))
+                    continue
+            counter = counters.get(metric)
+            if counter is None:
+                counter = self._add_counter(batch, metric, metrics, state)
+            if len(items) > counter.width:
+                # more values than labels, named after the metric
+                names = [
+                    metric + '_' + str(n)
+                    for n in xrange(counter.width, len(items))]
+                counter.widen(names, [
+                    state.column(counter.prefix + name) for name in names])
+            counter.add(index, items, ref_value)
+
+
+    def _add_counter(self, batch, metric, metrics, state):
+        """Adds the BatchCounter of a metric to the batch, with the
+        columns of its labels in 'state' (the ObjectValues).
+        """
+        (pretty, unit, prop, base, priv, publish_metric, summary,
+         deadband) = metrics[metric]
+        if summary is not None:
+            # histogram, the increments of its buckets (deltas) are
+            # only published as percentiles. Other histograms can have
+            # the same buckets, their columns are kept by metric.
+            prefix, bounds = summary
+            names = [prefix + '.' + name for name in SUMMARY]
+            counter = BatchCounter(
+                metric, 3, False, deadband, prefix=metric + '.')
+            counter.summary = (
+                bounds,
+                names,
+                [state.column(name) for name in names],
+                publish_metric
+            )
+        elif prop == 4 or prop == 5:
+            # mult * (metric - metric') / (ref_metric - ref_metric')
+            ref_name = metrics[base][0][0]
+            counter = BatchCounter(
+                metric, prop, publish_metric, deadband,
+                100.0 if prop == 5 else 1.0, ref_name,
+                state.column(ref_name))
+        else:
+            counter = BatchCounter(
+                metric, prop, publish_metric and prop in (1, 2, 3),
+                deadband)
+        counter.widen(pretty, [
+            state.column(counter.prefix + name) for name in pretty])
+        batch.counters[metric] = counter
+        batch.order.append(counter)
         return counter
 
 
-    def raw_metric(self, name, new):
-        """Raw metric calculator.
+    def _publish_batch(self, device, batch, state, publish):
+        """Calculates the metrics in the batch (see compute_metrics) and
+        publishes them. Their values are kept in 'state' as the last ones.
 
-        Returns the value of the metric as it was collected.
+        Returns  number of processed metrics
         """
-        return new
-
-
-    def derivative_metric(self, name, value, device,
-                          time_delta=True, interval=None, max_value=0):
-        """Calculate the derivative of the metric.
-
-        if it is a rate (time_delta=True)
-        # metric - metric' / interval
+        # all of them with the previous values, before any is replaced
+        computed = [
+            (counter, compute_metrics(batch, counter, state))
+            for counter in batch.order]
+        heartbeat = self._heartbeat_cycles(device)
+        msg = "Previous value for '%s' not found!. First time?"
+        processed = 0
+        values = []
+        for counter, (results, missing, ref_missing, zero) in computed:
+            processed += len(results)
+            for i in missing:
+                self.log.warning(msg, self._counter_path(batch, counter, i))
+            for i in ref_missing:
+                self.log.warning(
+                    msg, self._counter_path(batch, counter, i, True))
+            for i, derivative_x, derivative_y in zero:
+                self.log.debug(
+                    "Division by zero: %s=%s/%s=%s",
+                    self._counter_path(batch, counter, i),
+                    derivative_x,
+                    self._counter_path(batch, counter, i, True),
+                    derivative_y
+                )
+            if counter.summary is not None:
+                bounds, names, columns, publish_metric = counter.summary
+                width = counter.width
+                results = [
+                    value
+                    for start in xrange(0, len(results), width)
+                    for value in histogram_summary(
+                        results[start:start + width], bounds)]
+            else:
+                names = counter.names
+                columns = counter.columns
+                publish_metric = counter.publish
+            if not publish_metric:
+                self.log.debug(
+                    "Metric '%s' not requested to be published",
+                    counter.metric)
+                continue
+            self._publish_results(
+                batch, counter, names, columns, results, state, publish,
+                heartbeat, values)
+        self.publish_values(device, values)
+        # Move current values to last values
+        for counter in batch.order:
+            state.set_cells(batch.cells(counter, state.width), counter.values)
+        return processed
 
-        if it is a delta (time_delta=False)
-        # metric - metric'
 
-        where:
-                metric = current value of metric
-                metric' = previous value of metric
-                interval = time delta between the two values
+    def _publish_results(self, batch, counter, names, columns, results,
+                         state, publish, heartbeat, values):
+        """Adds to 'values' the (path, value) to publish of the results of
+        a counter, a result for each name of each instance, in 'columns'
+        of 'state' for the metrics published when they change.
         """
-        try:
-            old = self.last_values[device][name]
-            # Check for rollover
-            if value < old:
-                old = old - max_value
-            # Get Change in X (value)
-            derivative_x = value - old
-
-            # Get Change in Y (time)
-            derivative_y = 1.0
-            if time_delta:
-                # If we pass in a interval,
-                # use it rather then the configured one
-                if interval is None:
-                    derivative_y = float(self.config['interval'])
+        deadband = counter.deadband
+        cells = zip(names, columns)
+        i = 0
+        for index in counter.instances:
+            metrics_path, paths = batch.paths[index]
+            row = batch.rows[index]
+            for name, column in cells:
+                result = results[i]
+                i += 1
+                if result != result:
+                    # not collected for this instance
+                    continue
+                path = self._metric_path(paths, name, metrics_path)
+                if result == 0.0 and publish == 2:
+                    self.log.debug("Metric '%s' == 0.0 not published", path)
+                elif deadband is not None and not state.changed(
+                        row, column, result, deadband, heartbeat):
+                    self.log.debug("Metric '%s' not changed", path)
                 else:
-                    derivative_y = interval
-            result = derivative_x / derivative_y
-        except Exception as e:
-            msg = "Previous value for '%s' not found!. First time?"
-            self.log.warning(msg, name)
-            result = 0.0
-        return result
+                    values.append((path, result))
 
 
-    def _calc_derivative_refmetric(self, name, new, mult, ref_name,
-                                   data, metrics, device, instance):
-        """Prepare and calculate a derivate value of a metric depending on
-        the values of another. It works with averages or percentages.
+    def _counter_path(self, batch, counter, i, ref=False):
+        """Gets the metric path of the value 'i' of a counter of the batch,
+        or of its base metric if 'ref'.
         """
-        # mult * (metric - metric') / (ref_metric - ref_metric')
-        try:
-            ref_value = float(data[ref_name])
-        except KeyError:
-            path = self.get_metric_path(ref_name, instance)
-            raise ValueError("Metric '%s' was not collected!" % path)
-        except:
-            path = self.get_metric_path(ref_name, instance)
-            raise ValueError("Metric '%s' is not a float number!" % path)
-        (pretty, unit, prop, base, priv, publish_metric) = metrics[ref_name]
-        ref_path = self.get_metric_path(pretty[0], instance)
-        return self.derivative_refmetric(
-            name,
-            new,
-            ref_path,
-            ref_value,
-            device,
-            mult
-        )
-
-
-    def derivative_refmetric(self, name, value, ref_name, ref_value, device,
-                             pct=1.0, max_value=0.0):
-        """Calculate a derivate value of a metric depending on the values
-        of another.
+        index = counter.instances[i // counter.width]
+        metrics_path, paths = batch.paths[index]
+        if ref:
+            name = counter.ref_name
+        else:
+            name = counter.names[i % counter.width]
+        return self._metric_path(paths, name, metrics_path)
 
-        # pct * (metric - metric') / (ref_metric - ref_metric')
 
-        where:
-                metric = current value of metric
-                metric' = previous value of metric
-                ref_metric = current value of the base metric
-                ref_metric' = previous value of the base metric
-                pct = value of the multiplier. 100 to get a percentage
+    def publish_values(self, device, values, precision=4):
+        """Publishes a list of (path, value) of the device with
+        publish_metric, all of them with the same timestamp.
         """
-        try:
-            old = self.last_values[device][name]
-            # Check for rollover
-            if value < old:
-                old = old - max_value
-            # Get Change in X (value)
-            derivative_x = value - old
-        except:
-            # Error
-            msg = "Previous value for '%s' not found!. First time?"
-            self.log.warning(msg, name)
-            derivative_x = value
-        try:
-            # Not in last_processed_values, it must be raw!!!!
-            old = self.last_values[device][ref_name]
-            # Check for rollover
-            if ref_value < old:
-                old = old - max_value
-            # Get Change in X (value)
-            derivative_y = ref_value - old
-        except:
-            msg = "Previous value for '%s' not found!. First time?"
-            self.log.warning(msg, ref_name)
-            derivative_y = ref_value
-        # calc
-        try:
-            result = pct * derivative_x / derivative_y
-        except:
-            # Division by 0
-            self.log.debug(
-                "Division by zero: %s=%s/%s=%s",
-                name,
-                derivative_x,
-                ref_name,
-                derivative_y
-            )
-            result = 0.0
-        return result
+        if not values:
+            return
+        timestamp = int(time.time())
+        for path, value in values:
+            self.publish_metric(Metric(
+                path, value, timestamp=timestamp, precision=precision,
+                host=device))
 
 
     def get_metric_path(self, name, instance=None):
@@ -773,11 +1504,899 @@ class OntapClusterCollector(Collector):
         return '.'.join(value_list)
 
 
+    def _metric_path(self, paths, name, instance):
+        """Gets the metric path from 'paths' (see _add_metrics) or
+        builds it with get_metric_path and keeps it there.
+        """
+        try:
+            return paths[name]
+        except KeyError:
+            path = self.get_metric_path(name, instance)
+            paths[name] = path
+            return path
+
+
 # End of Diamond Collector Plugin
 
+# No value in an ObjectValues
+NAN = float('nan')
+
+
+class ObjectValues:
+    '''Last values of the counters of the instances of an object, and the
+    time of the collection of each instance.
+
+    Instances (by metric path) and counters (by name, or label for the
+    arrays) get a row and a column when they are seen for the first time.
+    The values are kept in a single array of doubles, row after row, with
+    NaN when there is no previous value, instead of a dict with the full
+    metric path of each one.
+
+    Each collection of the object is a cycle (see expire), the rows of
+    the instances not seen for some cycles are removed and reused.
+
+    For the metrics published only when they change (see changed), the
+    last value published and its cycle are kept in two more arrays with
+    the same layout, created the first time they are needed.
+    '''
+
+    def __init__(self, width=16):
+        # instance metric path -> row
+        self.rows = {}
+        # counter name -> column
+        self.columns = {}
+        # columns of each row, more than the counters to add new ones
+        self.width = width
+        self.values = array('d')
+        self.times = array('d')
+        # cycle in which each row was seen, rows removed to reuse
+        self.cycle = 0
+        self.seen = array('l')
+        self.free = []
+        self.collected = False
+        # last published values and their cycles
+        self.sent = None
+        self.sent_cycles = None
+
+
+    def planes(self):
+        """Returns the arrays with a value for each counter of each row."""
+        if self.sent is None:
+            return [self.values]
+        return [self.values, self.sent, self.sent_cycles]
+
+
+    def row(self, path):
+        """Returns the row of the instance, added if it is new."""
+        self.collected = True
+        try:
+            row = self.rows[path]
+        except KeyError:
+            pass
+        else:
+            self.seen[row] = self.cycle
+            return row
+        if self.free:
+            row = self.free.pop()
+            self.seen[row] = self.cycle
+        else:
+            row = len(self.times)
+            self.times.append(NAN)
+            self.seen.append(self.cycle)
+            for plane in self.planes():
+                plane.extend(array('d', [NAN]) * self.width)
+        self.rows[path] = row
+        return row
+
+
+    def expire(self, cycles):
+        """Ends the cycle if the object was collected, removing the
+        instances not seen in the last 'cycles' ones (0 = never).
+
+        Returns the number of instances removed.
+        """
+        if not self.collected:
+            return 0
+        self.collected = False
+        self.cycle += 1
+        if cycles <= 0:
+            return 0
+        oldest = self.cycle - cycles
+        removed = 0
+        empty = array('d', [NAN]) * self.width
+        for path, row in self.rows.items():
+            if self.seen[row] < oldest:
+                del self.rows[path]
+                start = row * self.width
+                for plane in self.planes():
+                    plane[start:start + self.width] = empty
+                self.times[row] = NAN
+                self.free.append(row)
+                removed += 1
+        return removed
+
+
+    def column(self, name):
+        """Returns the column of the counter, added if it is new."""
+        try:
+            return self.columns[name]
+        except KeyError:
+            pass
+        column = len(self.columns)
+        if column >= self.width:
+            self.resize(self.width * 2)
+        self.columns[name] = column
+        return column
+
+
+    def resize(self, width):
+        """Changes the number of columns of the rows."""
+        added = array('d', [NAN]) * (width - self.width)
+        planes = []
+        for plane in self.planes():
+            values = array('d')
+            for start in xrange(0, len(plane), self.width):
+                values.extend(plane[start:start + self.width])
+                values.extend(added)
+            planes.append(values)
+        self.values = planes[0]
+        if self.sent is not None:
+            self.sent, self.sent_cycles = planes[1:]
+        self.width = width
+
+
+    def series(self):
+        """Returns the number of values kept, of all the instances."""
+        if numpy is not None:
+            values = numpy.frombuffer(self.values, dtype=float)
+            return int(numpy.count_nonzero(values == values))
+        return sum(1 for value in self.values if value == value)
+
+
+    def get(self, row, column):
+        """Returns the value of a counter of an instance or NaN."""
+        return self.values[row * self.width + column]
+
+
+    def set(self, row, column, value):
+        self.values[row * self.width + column] = value
+
+
+    def set_cells(self, cells, values):
+        """Sets the values (an array of doubles) in their positions in the
+        array of values (see MetricBatch.cells), except the NaN ones.
+        """
+        if not values:
+            return
+        if numpy is not None:
+            last = numpy.frombuffer(self.values, dtype=float)
+            values = numpy.frombuffer(values, dtype=float)
+            known = values == values
+            last[cells[known]] = values[known]
+            return
+        last = self.values
+        for cell, value in zip(cells, values):
+            if value == value:
+                last[cell] = value
+
+
+    def changed(self, row, column, value, deadband, heartbeat):
+        """Decides if a value of a metric published only when it changes
+        has to be published: if it is the first one, if it differs from
+        the last one published more than deadband (band, relative), where
+        the band is a fraction of the last value if it is relative, or
+        if it was not published in the last 'heartbeat' cycles (0 = only
+        when it changes). The value is kept if it has to be published.
+
+        Returns True if it has to be published.
+        """
+        if self.sent is None:
+            self.sent = array('d', [NAN]) * len(self.values)
+            self.sent_cycles = array('d', [NAN]) * len(self.values)
+        slot = row * self.width + column
+        last = self.sent[slot]
+        age = self.cycle - self.sent_cycles[slot]
+        if last == last and (heartbeat <= 0 or age < heartbeat):
+            band, relative = deadband
+            if relative:
+                band = band * abs(last)
+            if abs(value - last) <= band:
+                return False
+        self.sent[slot] = value
+        self.sent_cycles[slot] = self.cycle
+        return True
+
+
+    def get_time(self, row):
+        """Returns the time of the last collection of an instance or None.
+        """
+        value = self.times[row]
+        if value != value:
+            return None
+        return value
+
+
+    def set_time(self, row, value):
+        if value is None:
+            value = NAN
+        self.times[row] = value
+
+
+class MetricBatch:
+    '''Values of the metrics of the instances of an object, and their
+    previous ones, to calculate them all together (see compute_metrics).
+
+    Each instance added gets an index in the batch, and the values of each
+    counter are kept by columns in its BatchCounter, instead of a list of
+    values with their properties.
+    '''
+
+    def __init__(self):
+        # row in the ObjectValues, seconds since the previous values (for
+        # rates) and (metric path, paths) of each instance
+        self.rows = array('l')
+        self.intervals = array('d')
+        self.paths = []
+        # rows of the instances in the batch
+        self.seen = set()
+        # metric -> BatchCounter, and the counters in order
+        self.counters = {}
+        self.order = []
+
+
+    def instance(self, row, interval, metrics_path, paths):
+        """Adds an instance, returns its index in the batch."""
+        self.rows.append(row)
+        self.intervals.append(interval)
+        self.paths.append((metrics_path, paths))
+        self.seen.add(row)
+        return len(self.paths) - 1
+
+
+    def cells(self, counter, width):
+        """Returns the positions of the values of a counter in the arrays
+        of an ObjectValues with rows of 'width' columns (as a NumPy array
+        when it is available).
+        """
+        if numpy is not None:
+            if not counter.instances:
+                return numpy.zeros(0, dtype=int)
+            rows = numpy.frombuffer(self.rows, dtype=numpy.int_)[
+                numpy.frombuffer(counter.instances, dtype=numpy.int_)]
+            return (rows[:, None] * width + counter.columns).ravel()
+        rows = self.rows
+        columns = counter.columns
+        return [
+            rows[index] * width + column
+            for index in counter.instances for column in columns]
+
+
+class BatchCounter:
+    '''Values of a counter (metric) of the instances of a MetricBatch, in a
+    single array of doubles, a row for each instance with a value for each
+    label of the arrays (NaN when the instance has less values).
+
+    Each label has a column in the ObjectValues of the object, named with
+    the label and the prefix. The kind is the property of the counter:
+    1 raw, 2 rate, 3 delta, 4 average and 5 percent.
+    '''
+
+    def __init__(self, metric, kind, publish, deadband=None, mult=1.0,
+                 ref_name=None, ref_column=0, prefix=''):
+        self.metric = metric
+        self.kind = kind
+        self.publish = publish
+        self.deadband = deadband
+        # base metric of averages (multiplier 1) and percentages (100):
+        # its label and column, and its value for each instance
+        self.mult = mult
+        self.ref_name = ref_name
+        self.ref_column = ref_column
+        self.ref_values = array('d')
+        self.prefix = prefix
+        self.names = []
+        self.columns = []
+        self.width = 0
+        # index in the batch of the instance of each row
+        self.instances = array('l')
+        self.values = array('d')
+        # histograms: (bounds, names, columns, publish) of the summary
+        self.summary = None
+
+
+    def widen(self, names, columns):
+        """Adds labels, with their columns in the ObjectValues."""
+        if self.instances:
+            added = array('d', [NAN]) * len(names)
+            values = array('d')
+            for start in xrange(0, len(self.values), self.width):
+                values.extend(self.values[start:start + self.width])
+                values.extend(added)
+            self.values = values
+        self.names = self.names + list(names)
+        self.columns = self.columns + list(columns)
+        self.width = len(self.names)
+
+
+    def add(self, index, items, ref_value=0.0):
+        """Adds the values (a list of floats) of an instance of the batch.
+        """
+        self.instances.append(index)
+        self.values.extend(items)
+        if len(items) < self.width:
+            self.values.extend(array('d', [NAN]) * (self.width - len(items)))
+        self.ref_values.append(ref_value)
+
+
+def compute_metrics(batch, counter, state):
+    """Calculates the metrics of a BatchCounter of a MetricBatch:
+
+        raw: metric
+        rate: (metric - metric') / interval
+        delta: metric - metric'
+        average: (metric - metric') / (ref_metric - ref_metric')
+        percent: 100 * (metric - metric') / (ref_metric - ref_metric')
+
+    where:
+            metric = current value of metric
+            metric' = previous value of metric
+            ref_metric = current value of the base metric
+            ref_metric' = previous value of the base metric
+
+    The previous values are in 'state', the ObjectValues of the object.
+    Rates and deltas are 0.0 without a previous value (or with interval
+    0). Averages and percentages use the current values when there are no
+    previous ones, and they are 0.0 when the divisor is 0.
+
+    Returns a tuple (results, missing, ref_missing, zero), where results
+    has a value for each one of the counter (NaN where it has no value),
+    missing and ref_missing are the indexes of the metrics without previous
+    value of the metric or of the base metric, and zero has (index,
+    dividend, divisor) of the divisions by 0. NumPy is used when it is
+    available.
+    """
+    if not counter.values:
+        return [], [], [], []
+    if numpy is not None:
+        return _compute_numpy(batch, counter, state)
+    return _compute_python(batch, counter, state)
+
+
+def _compute_python(batch, counter, state):
+    results = []
+    missing = []
+    ref_missing = []
+    zero = []
+    kind = counter.kind
+    last = state.values
+    width = state.width
+    values = counter.values
+    i = 0
+    for n, index in enumerate(counter.instances):
+        start = batch.rows[index] * width
+        interval = batch.intervals[index] if kind == 2 else 1.0
+        if kind == 4 or kind == 5:
+            ref_value = counter.ref_values[n]
+            ref_old = last[start + counter.ref_column]
+            if ref_old != ref_old:
+                derivative_y = ref_value
+            else:
+                derivative_y = ref_value - ref_old
+        for column in counter.columns:
+            value = values[i]
+            old = last[start + column]
+            if value != value:
+                results.append(NAN)
+            elif kind == 1:
+                results.append(value)
+            elif kind == 2 or kind == 3:
+                if old != old or interval == 0:
+                    missing.append(i)
+                    results.append(0.0)
+                else:
+                    results.append((value - old) / interval)
+            elif kind == 4 or kind == 5:
+                if old != old:
+                    missing.append(i)
+                    derivative_x = value
+                else:
+                    derivative_x = value - old
+                if ref_old != ref_old:
+                    ref_missing.append(i)
+                if derivative_y == 0:
+                    zero.append((i, derivative_x, derivative_y))
+                    results.append(0.0)
+                else:
+                    results.append(counter.mult * derivative_x / derivative_y)
+            else:
+                results.append(0.0)
+            i += 1
+    return results, missing, ref_missing, zero
+
+
+def _compute_numpy(batch, counter, state):
+    kind = counter.kind
+    width = counter.width
+    instances = numpy.frombuffer(counter.instances, dtype=numpy.int_)
+    starts = numpy.frombuffer(batch.rows, dtype=numpy.int_)[instances]
+    starts = starts * state.width
+    last = numpy.frombuffer(state.values, dtype=float)
+    values = numpy.frombuffer(counter.values, dtype=float)
+    old = last[(starts[:, None] + counter.columns).ravel()]
+    results = numpy.zeros(len(values))
+    none = numpy.zeros(len(values), dtype=bool)
+    missing = none
+    ref_missing = none
+    zero = []
+    with numpy.errstate(all='ignore'):
+        has_value = values == values
+        has_old = old == old
+        if kind == 1:
+            results[:] = values
+        elif kind == 2 or kind == 3:
+            if kind == 2:
+                interval = numpy.repeat(
+                    numpy.frombuffer(batch.intervals, dtype=float)[instances],
+                    width)
+            else:
+                interval = numpy.ones(len(values))
+            ok = has_old & (interval != 0)
+            results[ok] = (values[ok] - old[ok]) / interval[ok]
+            missing = has_value & ~ok
+        elif kind == 4 or kind == 5:
+            derivative_x = numpy.where(has_old, values - old, values)
+            ref_values = numpy.repeat(
+                numpy.frombuffer(counter.ref_values, dtype=float), width)
+            ref_old = numpy.repeat(last[starts + counter.ref_column], width)
+            has_ref_old = ref_old == ref_old
+            derivative_y = numpy.where(
+                has_ref_old, ref_values - ref_old, ref_values)
+            ok = derivative_y != 0
+            results[ok] = counter.mult * derivative_x[ok] / derivative_y[ok]
+            missing = has_value & ~has_old
+            ref_missing = has_value & ~has_ref_old
+            zero = [
+                (i, derivative_x[i], derivative_y[i])
+                for i in numpy.flatnonzero(has_value & ~ok)]
+        results[~has_value] = NAN
+    return (
+        results.tolist(),
+        numpy.flatnonzero(missing).tolist(),
+        numpy.flatnonzero(ref_missing).tolist(),
+        zero
+    )
+
+
+class MetricsFrame:
+    '''Values of the counters of the instances of an object by columns,
+    from NetAppMetrics.get_frame, instead of a dict of strings for each
+    instance (see get_metrics).
+
+    The rows are the instances (their names in self.instances) and the
+    columns are the counters, with a column for each value of the array
+    counters: self.columns has (counter, position) for each one and
+    self.names its name, the counter or the label of the value for the
+    arrays (from 'info', the result of get_info for the object, or
+    counter_position without it). self.values has an array('d') for each
+    column with the values of all the instances, NaN when an instance
+    does not have it or it is not a number. The counters which are not
+    numbers (node_name, ...) are in self.text, a list for each one with
+    the value of each instance or None. All of them were collected at
+    self.timestamp (from the device) and received at self.time.
+    '''
+
+    def __init__(self, info=None):
+        self.info = info or {}
+        self.instances = []
+        self.rows = {}
+        self.columns = []
+        self.names = []
+        # counter -> column of each position
+        self.index = {}
+        self.values = []
+        self.text = {}
+        self.timestamp = None
+        self.time = None
+
+
+    def row(self, instance):
+        """Returns the row of the instance, added if it is new."""
+        try:
+            return self.rows[instance]
+        except KeyError:
+            pass
+        row = len(self.instances)
+        self.rows[instance] = row
+        self.instances.append(instance)
+        for values in self.values:
+            values.append(NAN)
+        for values in self.text.itervalues():
+            values.append(None)
+        return row
+
+
+    def column(self, counter, position, size=1):
+        """Returns the column of a value of the counter, added if it is
+        new. 'size' is the number of values of the counter.
+        """
+        columns = self.index.setdefault(counter, [])
+        while len(columns) <= position:
+            n = len(columns)
+            try:
+                labels = self.info[counter][5]
+            except (KeyError, IndexError):
+                labels = []
+            if len(labels) > n:
+                name = labels[n]
+            elif labels or size > 1 or n > 0:
+                name = '%s_%d' % (counter, n)
+            else:
+                name = counter
+            columns.append(len(self.columns))
+            self.columns.append((counter, n))
+            self.names.append(name)
+            self.values.append(array('d', [NAN]) * len(self.instances))
+        return columns[position]
+
+
+    def set(self, row, counter, value):
+        """Sets the value (a string, maybe an array separated by ',') of a
+        counter of the instance in the row.
+        """
+        if value is None:
+            return
+        things = value.split(',')
+        size = len(things)
+        try:
+            items = map(float, things)
+        except ValueError:
+            if size == 1:
+                if counter not in self.text:
+                    self.text[counter] = [None] * len(self.instances)
+                self.text[counter][row] = value
+                return
+            items = []
+            for thing in things:
+                try:
+                    items.append(float(thing))
+                except ValueError:
+                    items.append(NAN)
+        try:
+            columns = self.index[counter]
+        except KeyError:
+            columns = ()
+        if len(columns) < size:
+            columns = [self.column(counter, n, size) for n in xrange(size)]
+        values = self.values
+        for column, item in zip(columns, items):
+            values[column][row] = item
+
+
+    def get(self, instance, name):
+        """Returns the value of the column 'name' of the instance or NaN.
+        """
+        return self.values[self.names.index(name)][self.rows[instance]]
+
+
+# Published for each histogram (see histogram_summary)
+SUMMARY = ('p50', 'p90', 'p99', 'max')
+PERCENTILES = (50.0, 90.0, 99.0)
+
+# Bounds of the histogram buckets, in microseconds
+BOUND = re.compile(r'(\d+(?:\.\d+)?)\s*([a-z]*)', re.IGNORECASE)
+BOUND_UNITS = {
+    '': 1.0, 'us': 1.0, 'usec': 1.0,
+    'ms': 1000.0, 'msec': 1000.0,
+    's': 1000000.0, 'sec': 1000000.0,
+}
+
+
+def histogram_bounds(labels):
+    """Gets the bounds of the buckets of a histogram from their labels,
+    like '<20us', '20us-<40us' or '>20s', in microseconds (or in the units
+    of the labels if they do not have units).
+
+    Returns a list of (lower, upper) bounds, upper is infinite for the
+    last bucket if it is '>...', or None if the labels are not bounds.
+    """
+    bounds = []
+    lower = 0.0
+    for label in labels:
+        values = []
+        for number, unit in BOUND.findall(label):
+            try:
+                values.append(float(number) * BOUND_UNITS[unit.lower()])
+            except KeyError:
+                return None
+        if not values:
+            return None
+        if label.strip().startswith('>'):
+            upper = float('inf')
+            lower = values[-1]
+        else:
+            upper = values[-1]
+            if len(values) > 1:
+                lower = values[0]
+        if upper < lower:
+            return None
+        bounds.append((lower, upper))
+        lower = upper
+    return bounds or None
+
+
+def histogram_summary(counts, bounds):
+    """Calculates the percentiles (PERCENTILES) and the maximum of the
+    values counted in the buckets of a histogram, interpolating between
+    the bounds of the bucket (the lower bound for the last open one).
+
+    Returns a list with the values of SUMMARY, all 0.0 without counts.
+    """
+    buckets = [
+        (count, lower, upper)
+        for count, (lower, upper) in zip(counts, bounds) if count > 0]
+    total = sum(count for count, lower, upper in buckets)
+    if total <= 0:
+        return [0.0] * len(SUMMARY)
+    summary = []
+    for percentile in PERCENTILES:
+        rank = total * percentile / 100.0
+        cumulative = 0.0
+        for count, lower, upper in buckets:
+            if cumulative + count >= rank:
+                break
+            cumulative += count
+        if upper == float('inf'):
+            summary.append(lower)
+        else:
+            summary.append(
+                lower + (upper - lower) * (rank - cumulative) / count)
+    count, lower, upper = buckets[-1]
+    summary.append(lower if upper == float('inf') else upper)
+    return summary
+
+
+class PrettyPath:
+    '''Builds the metric paths of the instances of an object from its
+    pretty name (object=pretty in the configuration), parsed only once.
+
+    The pretty name is split in items by '.', each one with the name of
+    the instance ('@') and the values of its counters ($counter or
+    ${counter}) replaced, like string.Template.safe_substitute, and the
+    characters not allowed in a metric path changed. Items without
+    replacements are prepared in advance. The path of an instance is
+    kept until the values of those counters change.
+    '''
+
+    invalid = re.compile(r'[^a-zA-Z0-9._]')
+
+    def __init__(self, pretty):
+        self.pretty = pretty
+        self.items = []
+        self.counters = []
+        self.paths = {}
+        for item in pretty.split('.'):
+            parts = self.parse(item)
+            if all(isinstance(part, basestring) for part in parts):
+                self.items.append(self.clean(''.join(parts)))
+            else:
+                self.items.append(parts)
+
+
+    def parse(self, item):
+        """Splits an item of the pretty name in a list of text, None (the
+        instance name) and (counter, placeholder) parts.
+        """
+        parts = []
+        def text(value):
+            for n, piece in enumerate(value.split('@')):
+                if n > 0:
+                    parts.append(None)
+                if piece:
+                    parts.append(piece)
+        pos = 0
+        for match in Template.pattern.finditer(item):
+            text(item[pos:match.start()])
+            pos = match.end()
+            counter = match.group('named') or match.group('braced')
+            if match.group('escaped') is not None:
+                parts.append(match.group('escaped'))
+            elif counter is not None:
+                parts.append((counter, match.group()))
+                if counter not in self.counters:
+                    self.counters.append(counter)
+            else:
+                text(match.group())
+        text(item[pos:])
+        return parts
+
+
+    def clean(self, item):
+        """Changes the characters not allowed in a metric path."""
+        item = item.replace('.', '_').strip('_')
+        item = item.replace('/', '.').strip('.')
+        return self.invalid.sub('_', item)
+
+
+    def build(self, device, instance, data):
+        """Returns the metric path of the instance."""
+        path = [device]
+        for item in self.items:
+            if isinstance(item, basestring):
+                path.append(item)
+                continue
+            value = []
+            for part in item:
+                if part is None:
+                    value.append(instance)
+                elif isinstance(part, tuple):
+                    if part[0] in data:
+                        value.append('%s' % data[part[0]])
+                    else:
+                        value.append(part[1])
+                else:
+                    value.append(part)
+            path.append(self.clean(''.join(value)))
+        return '.'.join(path)
+
+
+    def expire(self, paths):
+        """Forgets the instances whose metric path is not in 'paths'."""
+        for instance, cached in self.paths.items():
+            if cached[1] not in paths:
+                del self.paths[instance]
+
+
+    def get(self, device, instance, data):
+        """Gets the metric path of the instance and a dict to keep the
+        paths of its metrics, both reused while the values of the counters
+        of the pretty name do not change.
+
+        Returns a tuple (path, dict).
+        """
+        key = tuple(data.get(counter, self) for counter in self.counters)
+        try:
+            old_key, path, paths = self.paths[instance]
+        except KeyError:
+            pass
+        else:
+            if old_key == key:
+                return (path, paths)
+        path = self.build(device, instance, data)
+        paths = {}
+        self.paths[instance] = (key, path, paths)
+        return (path, paths)
+
+
+# A request of a NetAppMetrics task with its own response parser
+ZapiRequest = NamedTuple('ZapiRequest', ['request', 'parser'])
+
+
+class CachedRequest(NaServer.NaElement):
+    '''NaElement request which is encoded to XML only once, to be sent
+    again without changes (see NetAppMetrics._perf_request).
+    '''
+
+    __slots__ = ('encoded',)
+
+    def __init__(self, name, value=None):
+        super(CachedRequest, self).__init__(name, value)
+        self.encoded = None
+
+    def toEncodedString(self):
+        if self.encoded is None:
+            self.encoded = super(CachedRequest, self).toEncodedString()
+        return self.encoded
+
+
+class PerfInstancesParser:
+    '''Parser of the perf-object-get-instances and
+    perf-object-get-instances-iter-next responses.
+
+    It is used in place of the generic parser of NaServer, the
+    instances are not converted to NaElement objects: the name or uuid
+    of each one and the list of (counter, value) are kept in
+    self.instances. close() returns the results element only with its
+    attributes and its simple children (timestamp, records, ...).
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.instances = []
+        self.results = None
+        self.root = None
+        # names of the elements open, from the root
+        self.path = []
+        self.text = []
+        self.name = None
+        self.uuid = None
+        self.counters = None
+        self.counter = None
+        self.value = None
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.char_data
+
+    def feed(self, data):
+        self.parser.Parse(data, 0)
+
+    def close(self):
+        self.parser.Parse(b"", 1)
+        self.parser = None
+        if self.root != "netapp":
+            msg = "Zapi::parse_xml - Expected <netapp> element but got %s"
+            return self.server.fail_response(13001, msg % self.root)
+        if self.results is None:
+            msg = "Zapi::parse_xml - No results element in output!"
+            return self.server.fail_response(13001, msg)
+        return self.results
+
+    def start_element(self, name, attrs):
+        path = self.path
+        path.append(name)
+        self.text = []
+        depth = len(path)
+        if depth == 1:
+            self.root = name
+        elif depth == 2:
+            if name == "results" and self.results is None:
+                self.results = NaServer.NaElement(name)
+                for att in attrs:
+                    self.results.attr_set(att, attrs[att])
+        elif depth == 4:
+            if name == "instance-data" and path[2] == "instances":
+                self.name = None
+                self.uuid = None
+                self.counters = []
+        elif depth == 6:
+            if name == "counter-data" and path[4] == "counters":
+                self.counter = None
+                self.value = None
+
+    def end_element(self, name):
+        path = self.path
+        depth = len(path)
+        if depth >= 3 and path[1] == "results":
+            parent = path[-2]
+            if depth == 3:
+                if name != "instances":
+                    self.results.child_add_string(name, ''.join(self.text))
+            elif depth == 4:
+                if parent == "instances" and name == "instance-data":
+                    # instances without name are skipped
+                    if self.uuid or self.name:
+                        self.instances.append(
+                            (self.uuid or self.name, self.counters))
+                    self.counters = None
+            elif depth == 5:
+                if parent == "instance-data" and path[2] == "instances":
+                    if name == "name":
+                        self.name = ''.join(self.text)
+                    elif name == "uuid":
+                        self.uuid = ''.join(self.text)
+            elif self.counters is None or path[2:5] != [
+                    "instances", "instance-data", "counters"]:
+                pass
+            elif depth == 6:
+                if name == "counter-data" and self.counter is not None:
+                    self.counters.append((self.counter, self.value))
+            elif depth == 7 and parent == "counter-data":
+                if name == "name":
+                    self.counter = ''.join(self.text)
+                elif name == "value":
+                    self.value = ''.join(self.text)
+        path.pop()
+
+    def char_data(self, data):
+        self.text.append(data)
+
+
 class NetAppMetrics:
 
     perf_max_records = 500
+    max_cached_requests = 1024
+    max_cached_names = 65536
+    invalid_chars = re.compile(r'[^a-zA-Z0-9._]')
 
     def __init__(self, device, user, password, 
                  apiversion='1.12', timeout=None, vserver=''):
@@ -789,6 +2408,18 @@ class NetAppMetrics:
         self.minor = '0'
         self.apimajor = 0
         self.apiminor = 0
+        self.requests = {}
+        # raw -> normalised counter and instance names, and the previous
+        # generation of each cache (see _cache_name)
+        self.counter_names = {}
+        self.instance_names = {}
+        self.old_names = {'counter_names': {}, 'instance_names': {}}
+        # tag -> (iter-end api, start time) of the ZAPI iterators open
+        self.iterators = {}
+        # id -> list of the iterators opened by the tasks running in
+        # a thread (see _iterate), they are not left open
+        self.running = {}
+        self.iterators_lock = threading.Lock()
         self._connect(device, user, password, apiversion, timeout)
         self._set_vserver(vserver)
         self._get_version()
@@ -808,6 +2439,12 @@ class NetAppMetrics:
             self.server.set_timeout(timeout)
         self.device = device
 
+    def set_keep_alive(self, enable, pool_size=None, idle_timeout=None):
+        self.server.set_keep_alive(enable, pool_size, idle_timeout)
+
+    def close(self):
+        self.server.close()
+
     def _set_vserver(self, vserver=''):
         self.server.set_vserver(vserver)
         self.vserver = vserver
@@ -854,9 +2491,15 @@ class NetAppMetrics:
         return objects
 
     def get_info(self, kind):
+        return self._run(self._get_info(kind))
+
+    def get_info_async(self, loop, kind, callback):
+        self._spawn(loop, self._get_info(kind), callback)
+
+    def _get_info(self, kind):
         cmd = NaServer.NaElement("perf-object-counter-list-info")
         cmd.child_add_string("objectname", kind)
-        res = self.server.invoke_elem(cmd)
+        res = yield cmd
         counters = {}
         if res.results_errno():
             reason = res.results_reason()
@@ -882,7 +2525,170 @@ class NetAppMetrics:
                     tlabels = clabels.child_get_string("label-info")
                     labels = [l.strip() for l in tlabels.split(',')]
             counters[name] = (unit, properties, base, priv, desc, labels)
-        return counters
+        yield counters
+
+    def _run(self, task):
+        '''Runs a task until it returns its result.
+
+        A task is a generator which yields the NaElement requests to
+        send to the device (it gets back the response) and finally yields
+        its result. Errors invoking a request are raised inside the task.
+        A request can also be yielded as ZapiRequest to parse its
+        response with another parser (see PerfInstancesParser).
+        The ZAPI iterators started by the task and not ended by it (when
+        it fails or it is closed) are ended when it finishes.
+        '''
+        results = self._iterate(task)
+        try:
+            return next(results)
+        finally:
+            results.close()
+
+    def _iterate(self, task):
+        '''Runs a task (see _run) which can yield many results, until it
+        ends. The results are yielded as soon as the task gives them.
+        '''
+        response = None
+        error = None
+        opened = []
+        with self.iterators_lock:
+            self.running[id(opened)] = opened
+        try:
+            while True:
+                try:
+                    if error is None:
+                        item = task.send(response)
+                    else:
+                        item = task.throw(*error)
+                except StopIteration:
+                    return
+                response = None
+                error = None
+                if isinstance(item, NaServer.NaElement):
+                    item = ZapiRequest(item, None)
+                elif not isinstance(item, ZapiRequest):
+                    yield item
+                    continue
+                try:
+                    response = self.server.invoke_elem(
+                        item.request, item.parser)
+                except Exception:
+                    error = sys.exc_info()
+                else:
+                    self._track_iterator(item.request, response, opened)
+        finally:
+            task.close()
+            for tag in opened:
+                self._end_iterator(tag)
+            with self.iterators_lock:
+                del self.running[id(opened)]
+
+    def _spawn(self, loop, task, callback):
+        '''Runs a task (see _run) on a NaServer.NaEventLoop.
+
+        The requests are sent with invoke_elem_async. When the task ends,
+        callback(result, error) is called from the loop, where error
+        is None or the exception raised by the task. The iterators not
+        ended by the task are ended then, without waiting for them.
+        '''
+        opened = []
+        sent = [None]
+
+        def finish(result, error):
+            for tag in opened:
+                self._end_iterator(tag, loop)
+            callback(result, error)
+
+        def step(response=None):
+            if sent[0] is not None:
+                self._track_iterator(sent[0], response, opened)
+            try:
+                item = task.send(response)
+            except Exception as e:
+                finish(None, e)
+                return
+            if isinstance(item, NaServer.NaElement):
+                item = ZapiRequest(item, None)
+            elif not isinstance(item, ZapiRequest):
+                task.close()
+                finish(item, None)
+                return
+            sent[0] = item.request
+            self.server.invoke_elem_async(
+                item.request, loop, step, item.parser)
+        step()
+
+    def _track_iterator(self, request, response, opened):
+        '''Keeps the tag of the ZAPI iterators started by a task in
+        self.iterators (and in the list opened) until they are ended.
+        '''
+        api = request.element['name']
+        if api.endswith('-iter-start'):
+            tag = response.child_get_string("tag")
+            if tag and not response.results_errno():
+                with self.iterators_lock:
+                    self.iterators[tag] = (
+                        api[:-len('start')] + 'end', time.time())
+                    opened.append(tag)
+        elif api.endswith('-iter-end') and not response.results_errno():
+            with self.iterators_lock:
+                self.iterators.pop(request.child_get_string("tag"), None)
+
+    def _end_iterator(self, tag, loop=None):
+        '''Ends the iterator 'tag' if it is still open, on the event loop
+        if it is given. It stays in self.iterators if it fails.
+        '''
+        with self.iterators_lock:
+            iterator = self.iterators.get(tag)
+        if iterator is None:
+            return
+        cmd = NaServer.NaElement(iterator[0])
+        cmd.child_add_string("tag", tag)
+
+        def ended(response):
+            if not response.results_errno():
+                with self.iterators_lock:
+                    self.iterators.pop(tag, None)
+
+        if loop is not None:
+            self.server.invoke_elem_async(cmd, loop, ended)
+            return
+        try:
+            ended(self.server.invoke_elem(cmd))
+        except Exception:
+            pass
+
+    def open_iterators(self):
+        '''Returns a list of (tag, iter-end api, seconds since started)
+        of the ZAPI iterators open on the device, but the ones of the
+        tasks still running in other threads (like a refresh of the
+        instances in background), which end them.
+        '''
+        now = time.time()
+        with self.iterators_lock:
+            running = set()
+            for opened in self.running.values():
+                running.update(opened)
+            return [(tag, api, now - started)
+                    for tag, (api, started) in self.iterators.items()
+                    if tag not in running]
+
+    def close_iterators(self):
+        '''Ends the ZAPI iterators still open, which were left by requests
+        which could not be completed (timeouts, connection errors, ...).
+        It must not be called while requests are running on an event
+        loop, the ones of the tasks running in threads are left open.
+
+        Returns the list of the ones which cannot be ended, like
+        open_iterators, they are not tried again.
+        '''
+        for tag, api, age in self.open_iterators():
+            self._end_iterator(tag)
+        failed = self.open_iterators()
+        with self.iterators_lock:
+            for tag, api, age in failed:
+                self.iterators.pop(tag, None)
+        return failed
 
     def _invoke(self, cmd):
         '''Exposes underlying NetApp API for invoking'''
@@ -924,7 +2730,7 @@ class NetAppMetrics:
         instances_list = []
         cmd = NaServer.NaElement("perf-object-instance-list-info-iter-start")
         cmd.child_add_string("objectname", kind)
-        res = self.server.invoke_elem(cmd)
+        res = yield cmd
         if res.results_errno():
             reason = res.results_reason()
             msg = (
@@ -940,13 +2746,13 @@ class NetAppMetrics:
             )
             cmd.child_add_string("tag", next_tag)
             cmd.child_add_string("maximum", self.perf_max_records)
-            res = self.server.invoke_elem(cmd)
+            res = yield cmd
             if res.results_errno():
                 reason = res.results_reason()
                 msg = ("perf-object-instance-list-info-iter-next"
                        " cannot collect '%s': %s")
                 raise ValueError(msg % (kind, reason))
-            counter = res.child_get_string("records")
+            counter = int(res.child_get_string("records"))
             instances = res.child_get("instances")
             if instances:
                 for inst in instances.children_get():
@@ -954,7 +2760,7 @@ class NetAppMetrics:
                     instances_list.append(name)
         cmd = NaServer.NaElement("perf-object-instance-list-info-iter-end")
         cmd.child_add_string("tag", next_tag)
-        res = self.server.invoke_elem(cmd)
+        res = yield cmd
         if res.results_errno():
             reason = res.results_reason()
             msg = (
@@ -964,13 +2770,12 @@ class NetAppMetrics:
             raise ValueError(msg % (kind, reason))
 
         # filter
-        return instances_list
+        yield instances_list
 
     def __clusterm_instances(self, kind, filter=''):
-        counter = self.perf_max_records
         next_tag = ''
         instances_list = []
-        while counter == self.perf_max_records:
+        while True:
             cmd = NaServer.NaElement("perf-object-instance-list-info-iter")
             cmd.child_add_string("objectname", kind)
             if filter:
@@ -978,7 +2783,7 @@ class NetAppMetrics:
             if next_tag:
                 cmd.child_add_string("tag", next_tag)
             cmd.child_add_string("max-records", self.perf_max_records)
-            res = self.server.invoke_elem(cmd)
+            res = yield cmd
             if res.results_errno():
                 reason = res.results_reason()
                 msg = (
@@ -987,44 +2792,48 @@ class NetAppMetrics:
                 )
                 raise ValueError(msg % (kind, reason))
             next_tag = res.child_get_string("next-tag")
-            counter = res.child_get_string("num-records")
+            counter = int(res.child_get_string("num-records") or 0)
             attr_list = res.child_get("attributes-list")
             if attr_list:
                 for inst in attr_list.children_get():
                     name = inst.child_get_string("uuid")
                     instances_list.append(name)
-        return instances_list
+            # the last page has no next-tag, whatever its size
+            if not next_tag or counter == 0:
+                break
+        yield instances_list
 
     def get_instances(self, kind, filter=''):
+        return self._run(self._get_instances(kind, filter))
+
+    def get_instances_async(self, loop, kind, filter, callback):
+        self._spawn(loop, self._get_instances(kind, filter), callback)
+
+    def _get_instances(self, kind, filter=''):
         if self.clustered:
             return self.__clusterm_instances(kind, filter)
         else:
             return self.__sevenm_instances(kind, filter)
 
-    def __collect_instances(self, response):
+    def __collect_instances(self, response, parser):
         metrics = {}
         times = {}
-        for instance in response.child_get("instances").children_get():
+        counter_names = self.counter_names
+        # (uuid or name, [(counter, value), ...]) from PerfInstancesParser
+        for name, counters_list in parser.instances:
             instance_data = {}
-            counters_list = instance.child_get("counters").children_get()
-            for counter in counters_list:
-                raw_metricname = counter.child_get_string("name")
-                raw_metricname = unicodedata.normalize('NFKD', raw_metricname)
-                metric = raw_metricname.encode('ascii', 'ignore')
-                instance_data[metric] = counter.child_get_string("value")
-            # get a instance name
-            if instance.child_get_string("uuid"):
-                name = instance.child_get_string("uuid")
+            for raw_metricname, value in counters_list:
+                try:
+                    metric = counter_names[raw_metricname]
+                except KeyError:
+                    metric = self.__counter_name(raw_metricname)
+                instance_data[metric] = value
+            name = self.__instance_name(name)
+            if name in metrics:
+                # 7-Mode, more counters of the previous record
+                metrics[name].update(instance_data)
             else:
-                name = instance.child_get_string("name")
-            name = unicodedata.normalize('NFKD', name)
-            # Optimize please!!!!!
-            name = name.encode('ascii', 'ignore')
-            name = name.replace('.', '_').strip('_')
-            name = name.replace('/', '.').strip('.')
-            name = re.sub(r'[^a-zA-Z0-9._]', '_', name)
-            #name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
-            metrics[name] = instance_data
+                metrics[name] = instance_data
             # Keep track of how long has passed since we checked last
             times[name] = time.time()
         instance_time = None
@@ -1032,10 +2841,84 @@ class NetAppMetrics:
             instance_time = float(response.child_get_string("timestamp"))
         return metrics, times, instance_time
 
-    def __sevenm_metrics(self, kind, instances, metrics):
-        values = {}
-        times = {}
-        cmd = NaServer.NaElement("perf-object-get-instances-iter-start")
+    def __collect_frame(self, frame, parser):
+        counter_names = self.counter_names
+        for name, counters_list in parser.instances:
+            row = frame.row(self.__instance_name(name))
+            for raw_metricname, value in counters_list:
+                try:
+                    metric = counter_names[raw_metricname]
+                except KeyError:
+                    metric = self.__counter_name(raw_metricname)
+                frame.set(row, metric, value)
+        frame.time = time.time()
+
+    def _cache_name(self, kind, name, value):
+        '''Keeps the normalised (and interned) value of a counter or
+        instance name in the cache 'kind' (counter_names or
+        instance_names), the same names come in every response.
+
+        When the cache is full it becomes the previous generation and a
+        new one is started. The names found in the previous generation
+        are moved to the new one, the others (instances which do not
+        exist anymore) are dropped with it at the next swap. So the names
+        in use are never lost at once, with max_cached_names names at
+        most in each generation.
+        '''
+        cache = getattr(self, kind)
+        if len(cache) >= self.max_cached_names:
+            self.old_names[kind] = cache
+            cache = {}
+            setattr(self, kind, cache)
+        cache[name] = value
+        return value
+
+    def __counter_name(self, name):
+        try:
+            return self.counter_names[name]
+        except KeyError:
+            pass
+        metric = self.old_names['counter_names'].get(name)
+        if metric is None:
+            metric = unicodedata.normalize('NFKD', name)
+            metric = intern(metric.encode('ascii', 'ignore'))
+        return self._cache_name('counter_names', name, metric)
+
+    def __instance_name(self, name):
+        try:
+            return self.instance_names[name]
+        except KeyError:
+            pass
+        value = self.old_names['instance_names'].get(name)
+        if value is None:
+            value = unicodedata.normalize('NFKD', name)
+            value = value.encode('ascii', 'ignore')
+            value = value.replace('.', '_').strip('_')
+            value = value.replace('/', '.').strip('.')
+            value = intern(self.invalid_chars.sub('_', value))
+        return self._cache_name('instance_names', name, value)
+
+    def _perf_request(self, api, kind, instances, metrics, build):
+        '''Returns the CachedRequest built by build(api, kind, instances,
+        metrics). The one of the previous call for the same api, kind and
+        first instance (of a batch) is reused if the instances and metrics
+        did not change, so the same XML request is not built and encoded
+        again every cycle.
+        '''
+        args = (tuple(instances), tuple(metrics))
+        key = (api, kind, args[0][:1])
+        cached = self.requests.get(key)
+        if cached is not None and cached[0] == args:
+            return cached[1]
+        cmd = build(api, kind, instances, metrics)
+        if len(self.requests) >= self.max_cached_requests:
+            # batches starting with instances which do not exist anymore
+            self.requests.clear()
+        self.requests[key] = (args, cmd)
+        return cmd
+
+    def __sevenm_request(self, api, kind, instances, metrics):
+        cmd = CachedRequest(api)
         cmd.child_add_string("objectname", kind)
         counters = NaServer.NaElement("counters")
         for metric in metrics:
@@ -1045,7 +2928,13 @@ class NetAppMetrics:
         for inst in instances:
             insts.child_add_string("instance", inst)
         cmd.child_add(insts)
-        res = self.server.invoke_elem(cmd)
+        return cmd
+
+    def __sevenm_metrics(self, kind, instances, metrics, frame=None):
+        cmd = self._perf_request(
+            "perf-object-get-instances-iter-start", kind, instances,
+            metrics, self.__sevenm_request)
+        res = yield cmd
         if res.results_errno():
             reason = res.results_reason()
             msg = (
@@ -1055,12 +2944,16 @@ class NetAppMetrics:
             raise ValueError(msg % (kind, reason))
         next_tag = res.child_get_string("tag")
         instance_time = float(res.child_get_string("timestamp"))
+        # last instance of the previous page, its counters can continue
+        # in the next one: (name, data, time)
+        last = None
         counter = self.perf_max_records
         while counter == self.perf_max_records:
             cmd = NaServer.NaElement("perf-object-get-instances-iter-next")
             cmd.child_add_string("tag", next_tag)
             cmd.child_add_string("maximum", self.perf_max_records)
-            res = self.server.invoke_elem(cmd)
+            parser = PerfInstancesParser(self.server)
+            res = yield ZapiRequest(cmd, parser)
             if res.results_errno():
                 reason = res.results_reason()
                 msg = (
@@ -1068,31 +2961,41 @@ class NetAppMetrics:
                         " cannot collect '%s': %s"
                 )
                 raise ValueError(msg % (kind, reason))
-            counter = res.child_get_string("records")
-            partial_values, partial_times, partial_inst_t \
-                = self.__collect_instances(res)
-            # Mix them with the previous records of the same instance
-            # WARNING, BUG with same instance and time!!!!!!!!!
-            for instance, values in values.iteritems():
-                if instance in partial_values:
-                    values.update(partial_values[instance])
-                    del partial_values[instance]
-            values.update(partial_values)
-            times.update(partial_times)
-        cmd = NaServer.NaElement("perf-object-instance-list-info-iter-end")
+            counter = int(res.child_get_string("records"))
+            if frame is not None:
+                # the counters of an instance go to the same row
+                self.__collect_frame(frame, parser)
+                continue
+            values, times, partial_inst_t \
+                = self.__collect_instances(res, parser)
+            # Mix it with the records of the same instance in this page
+            if last is not None:
+                name, data, last_time = last
+                data.update(values.get(name, {}))
+                values[name] = data
+                times.setdefault(name, last_time)
+                last = None
+            if counter == self.perf_max_records and parser.instances:
+                name = self.__instance_name(parser.instances[-1][0])
+                last = (name, values.pop(name), times.pop(name))
+            if values:
+                yield values, times, instance_time
+        cmd = NaServer.NaElement("perf-object-get-instances-iter-end")
         cmd.child_add_string("tag", next_tag)
-        res = self.server.invoke_elem(cmd)
+        res = yield cmd
         if res.results_errno():
             reason = res.results_reason()
             msg = (
-                    "perf-object-instance-list-info-iter-end"
+                    "perf-object-get-instances-iter-end"
                     " cannot collect '%s': %s"
             )
             raise ValueError(msg % (kind, reason))
-        return values, times, instance_time
+        if frame is not None:
+            frame.timestamp = instance_time
+            yield frame
 
-    def __clusterm_metrics(self, kind, instances, metrics):
-        cmd = NaServer.NaElement("perf-object-get-instances")
+    def __clusterm_request(self, api, kind, instances, metrics):
+        cmd = CachedRequest(api)
         inst = NaServer.NaElement("instance-uuids")
         for instance in instances:
             inst.child_add_string("instance-uuid", instance)
@@ -1102,19 +3005,105 @@ class NetAppMetrics:
         for metric in metrics:
             counters.child_add_string("counter", metric)
         cmd.child_add(counters)
-        res = self.server.invoke_elem(cmd)
+        return cmd
+
+    def __clusterm_metrics(self, kind, instances, metrics, frame=None):
+        cmd = self._perf_request(
+            "perf-object-get-instances", kind, instances, metrics,
+            self.__clusterm_request)
+        parser = PerfInstancesParser(self.server)
+        res = yield ZapiRequest(cmd, parser)
         if res.results_errno():
             reason = res.results_reason()
             msg = "perf-object-get-instances cannot collect '%s': %s"
             raise ValueError(msg % (kind, reason))
-        return self.__collect_instances(res)
+        if frame is None:
+            yield self.__collect_instances(res, parser)
+            return
+        self.__collect_frame(frame, parser)
+        if res.child_get_string("timestamp"):
+            frame.timestamp = float(res.child_get_string("timestamp"))
+        yield frame
 
     def get_metrics(self, kind, instances, metrics=[]):
+        return self._run(self._get_metrics(kind, instances, metrics))
+
+    def iter_metrics(self, kind, instances, metrics=[]):
+        '''Gets the same values as get_metrics, but yields them while
+        they are received: a tuple (values, times, instance_t) for each
+        page of the response in 7-Mode (the counters of an instance are
+        never split in two of them), only one in cluster mode.
+        '''
+        return self._iterate(self._get_pages(kind, instances, metrics))
+
+    def get_metrics_async(self, loop, kind, instances, metrics, callback):
+        self._spawn(
+            loop, self._get_metrics(kind, instances, metrics), callback)
+
+    def get_frame(self, kind, instances, metrics=[], info=None):
+        '''Gets the same values as get_metrics in a MetricsFrame, already
+        converted to numbers, with the arrays split in a column for each
+        label (from info, the result of get_info for the object).
+        '''
+        return self._run(self._get_frame(kind, instances, metrics, info))
+
+    def get_frame_async(self, loop, kind, instances, metrics, callback,
+                        info=None):
+        self._spawn(
+            loop, self._get_frame(kind, instances, metrics, info), callback)
+
+    def _get_metrics(self, kind, instances, metrics=[]):
+        if self.clustered:
+            return self.__clusterm_metrics(kind, instances, metrics)
+        else:
+            return self._merge_pages(
+                self.__sevenm_metrics(kind, instances, metrics))
+
+    def _get_frame(self, kind, instances, metrics=[], info=None):
+        frame = MetricsFrame(info)
+        if self.clustered:
+            return self.__clusterm_metrics(kind, instances, metrics, frame)
+        else:
+            return self.__sevenm_metrics(kind, instances, metrics, frame)
+
+    def _get_pages(self, kind, instances, metrics=[]):
         if self.clustered:
             return self.__clusterm_metrics(kind, instances, metrics)
         else:
             return self.__sevenm_metrics(kind, instances, metrics)
 
+    def _merge_pages(self, pages):
+        '''Task which runs the task 'pages' (its requests are passed
+        through) and yields all the (values, times, instance_t) results
+        of the pages merged in one.
+        '''
+        values = {}
+        times = {}
+        instance_time = None
+        response = None
+        error = None
+        while True:
+            try:
+                if error is None:
+                    item = pages.send(response)
+                else:
+                    item = pages.throw(*error)
+            except StopIteration:
+                break
+            response = None
+            error = None
+            if isinstance(item, (NaServer.NaElement, ZapiRequest)):
+                try:
+                    response = yield item
+                except Exception:
+                    error = sys.exc_info()
+                continue
+            page_values, page_times, instance_time = item
+            for instance, data in page_values.iteritems():
+                values.setdefault(instance, {}).update(data)
+            times.update(page_times)
+        yield values, times, instance_time
+
 
 # TODO: Change to argparse
 # command line
@@ -1134,6 +3123,8 @@ Where <action> could be:
  * instances <object> : returns the name of all instaces of <object>
  * metrics <object> [instace]: returns all counters for all instances
    or if one instances is provided, only for that one.
+ * values <object> [instace]: like metrics, but as numbers, with a
+   value for each label of the arrays.
 
 (c) Jose Riguera Lopez, 2013-2015 <jose.riguera@springer.com>
 
@@ -1259,6 +3250,35 @@ def main(argv):
                 print("\t %s = %s" % (k2, v2))
             print
         print("%d instances found" % len(m))
+    elif args[0] == 'values':
+        try:
+            item = args[1]
+        except:
+            print("You need to specify the object!")
+            sys.exit(1)
+        try:
+            info = netapp.get_info(item)
+            try:
+                inst = [args[2]]
+            except:
+                inst = netapp.get_instances(item)
+            frame = netapp.get_frame(item, inst, [], info)
+        except Exception as e:
+            print(str(e))
+            sys.exit(1)
+        date = datetime.datetime.fromtimestamp(frame.timestamp)
+        columns = sorted(zip(frame.names, frame.values))
+        for k in sorted(frame.instances):
+            print("%s (%s):" % (k, date))
+            row = frame.rows[k]
+            for name, values in sorted(frame.text.iteritems()):
+                if values[row] is not None:
+                    print("\t %s = %s" % (name, values[row]))
+            for name, values in columns:
+                if values[row] == values[row]:
+                    print("\t %s = %s" % (name, values[row]))
+            print
+        print("%d instances found" % len(frame.instances))
     else:
         print("What do you want?")
 
@@ -0,0 +1,591 @@
+# coding=utf-8
+#
+# Tests of the calculations of the OntapClusterCollector, and of the ZAPI
+# messages with canned responses, they do not need Diamond nor a filer:
+# python -m pytest test
+
+import os
+import sys
+import re
+import random
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ontap'))
+
+import ontapng
+from ontapng import ObjectValues, MetricBatch, BatchCounter, NAN
+from ontapng import histogram_bounds, histogram_summary
+
+
+class Collector(ontapng.OntapClusterCollector):
+    '''Collector with only what _add_metrics and _publish_batch need, the
+    values published are kept in self.published.
+    '''
+
+    def __init__(self):
+        self.log = logging.getLogger('test')
+        self.config = {'heartbeat_cycles': 0}
+        self.published = {}
+
+    def get_metric_path(self, name, instance=None):
+        return instance + '.' + name
+
+    def publish_values(self, device, values, precision=4):
+        self.published.update(values)
+
+
+LABELS = ['<20us', '<40us', '<60us', '>60us']
+
+
+def histogram(name):
+    return (LABELS, 'none', 3, None, None, True,
+            (name, histogram_bounds(LABELS)), None)
+
+
+def collect(collector, metrics, data, state):
+    """Collects the metrics of an instance, returns the ones published."""
+    batch = MetricBatch()
+    row = state.row('vol0')
+    collector._add_metrics(batch, 'vol0', data, 60.0, metrics, state, row)
+    collector.published = {}
+    collector._publish_batch('dev0', batch, state, 1)
+    return collector.published
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'python'])
+def test_histograms_with_same_buckets(engine, monkeypatch):
+    # the buckets of each histogram keep their own previous values
+    if engine == 'python':
+        monkeypatch.setattr(ontapng, 'numpy', None)
+    elif ontapng.numpy is None:
+        pytest.skip("NumPy is not installed")
+    data = [
+        {'read_hist': '10,10,10,0', 'write_hist': '0,5,10,0'},
+        {'read_hist': '20,30,20,0', 'write_hist': '0,5,30,10'},
+    ]
+    both = {'read_hist': histogram('read'), 'write_hist': histogram('write')}
+    collector = Collector()
+    state = ObjectValues()
+    for values in data:
+        together = collect(collector, both, values, state)
+    for metric, prefix in (('read_hist', 'vol0.read.'),
+                           ('write_hist', 'vol0.write.')):
+        state = ObjectValues()
+        for values in data:
+            alone = collect(collector, {metric: both[metric]}, values, state)
+        for name in ontapng.SUMMARY:
+            assert together[prefix + name] == alone[prefix + name]
+    assert together['vol0.read.max'] == 60.0
+    assert together['vol0.read.p50'] == 30.0
+    assert together['vol0.write.max'] == 60.0
+
+
+def test_histogram_summary():
+    bounds = histogram_bounds(['<20us', '<40us', '<1ms', '<2s', '>20s'])
+    assert bounds == [(0.0, 20.0), (20.0, 40.0), (40.0, 1000.0),
+                      (1000.0, 2000000.0), (20000000.0, float('inf'))]
+    assert histogram_summary([0, 10, 0, 0, 0], bounds) == [
+        30.0, 38.0, 39.8, 40.0]
+    # the last bucket is open, its lower bound is used
+    assert histogram_summary([50, 40, 9, 0, 1], bounds) == [
+        20.0, 40.0, 1000.0, 20000000.0]
+    assert histogram_summary([0, 0, 0, 0, 0], bounds) == [0.0] * 4
+    # negative increments (counters reset) are not counted
+    assert histogram_summary([-5, 10, 0, 0, 0], bounds)[-1] == 40.0
+    assert histogram_bounds(['a', 'b']) is None
+
+
+def random_batch(kind, seed):
+    """Returns (batch, counter, state) with random values of a counter of
+    the kind for some instances, some of them without previous values.
+    """
+    rnd = random.Random(seed)
+    numbers = [0.0, 1.0, 5.5, -3.0, 1e18]
+    state = ObjectValues(4)
+    batch = MetricBatch()
+    counter = BatchCounter(
+        'metric', kind, True, mult=100.0 if kind == 5 else 1.0,
+        ref_name='base', ref_column=state.column('base'))
+    counter.widen(['a', 'b', 'c'], [state.column(name)
+                                    for name in ('a', 'b', 'c')])
+    for n in range(rnd.randint(1, 30)):
+        row = state.row('vol%i' % n)
+        for column in counter.columns + [counter.ref_column]:
+            state.set(row, column, rnd.choice(
+                numbers + [NAN, rnd.random() * 100]))
+        index = batch.instance(
+            row, rnd.choice([0.0, 60.0, 59.5, -1.0]), 'vol%i' % n, {})
+        items = [rnd.choice(numbers + [rnd.random() * 100])
+                 for i in range(rnd.randint(0, 3))]
+        counter.add(index, items, rnd.choice([0.0, 2.0, rnd.random()]))
+    return batch, counter, state
+
+
+def expected(batch, counter, state):
+    """The metrics of the counter calculated one by one."""
+    results = []
+    i = 0
+    for n, index in enumerate(counter.instances):
+        row = batch.rows[index]
+        interval = batch.intervals[index]
+        ref_value = counter.ref_values[n]
+        ref_old = state.get(row, counter.ref_column)
+        for column in counter.columns:
+            value = counter.values[i]
+            old = state.get(row, column)
+            i += 1
+            if value != value:
+                results.append(None)
+            elif counter.kind == 1:
+                results.append(value)
+            elif counter.kind in (2, 3):
+                if counter.kind == 3:
+                    interval = 1.0
+                if old != old or interval == 0:
+                    results.append(0.0)
+                else:
+                    results.append((value - old) / interval)
+            else:
+                x = value if old != old else value - old
+                y = ref_value if ref_old != ref_old else ref_value - ref_old
+                results.append(0.0 if y == 0 else counter.mult * x / y)
+    return results
+
+
+@pytest.mark.parametrize('kind', [0, 1, 2, 3, 4, 5])
+def test_compute_python(kind):
+    for seed in range(50):
+        batch, counter, state = random_batch(kind, seed)
+        results = ontapng._compute_python(batch, counter, state)[0]
+        results = [None if value != value else value for value in results]
+        if kind == 0:
+            assert all(value in (0.0, None) for value in results)
+        else:
+            assert results == expected(batch, counter, state)
+
+
+@pytest.mark.skipif(ontapng.numpy is None, reason="NumPy is not installed")
+@pytest.mark.parametrize('kind', [0, 1, 2, 3, 4, 5])
+def test_compute_numpy(kind):
+    for seed in range(50):
+        batch, counter, state = random_batch(kind, seed)
+        python = ontapng._compute_python(batch, counter, state)
+        results, missing, ref_missing, zero = ontapng._compute_numpy(
+            batch, counter, state)
+        assert [None if value != value else value for value in results] \
+            == [None if value != value else value for value in python[0]]
+        assert missing == python[1]
+        assert ref_missing == python[2]
+        assert [i for i, x, y in zero] == [i for i, x, y in python[3]]
+
+
+def test_changed():
+    state = ObjectValues()
+    row = state.row('vol0')
+    column = state.column('size')
+    absolute = (5.0, False)
+    assert state.changed(row, column, 100.0, absolute, 0)
+    assert not state.changed(row, column, 104.0, absolute, 0)
+    assert not state.changed(row, column, 95.0, absolute, 0)
+    assert state.changed(row, column, 106.0, absolute, 0)
+    # relative to the last value published (106)
+    relative = (0.1, True)
+    assert not state.changed(row, column, 116.0, relative, 0)
+    assert state.changed(row, column, 117.0, relative, 0)
+    # only when it changes
+    changes = (0.0, False)
+    assert not state.changed(row, column, 117.0, changes, 0)
+    assert state.changed(row, column, 117.5, changes, 0)
+
+
+def test_changed_heartbeat():
+    state = ObjectValues()
+    row = state.row('vol0')
+    column = state.column('size')
+    published = []
+    for cycle in range(7):
+        published.append(state.changed(row, column, 1.0, (0.0, False), 3))
+        state.expire(0)
+        state.row('vol0')
+    assert published == [True, False, False, True, False, False, True]
+
+
+@pytest.mark.parametrize('label, deadband', [
+    ('size', None),
+    ('size|changes', (0.0, False)),
+    (' size | changes ', (0.0, False)),
+    ('size|deadband=5', (5.0, False)),
+    ('size|deadband=5%', (0.05, True)),
+    ('-|deadband= 2.5 ', (2.5, False)),
+    ('size|deadband=x', None),
+    ('size|deadband=5|changes', (0.0, False)),
+    ('size|sometimes', None),
+])
+def test_metric_modes(label, deadband):
+    collector = Collector()
+    info = {'size_total': ('b', 'raw', '', 'basic', 'size', [])}
+    metric = collector._OntapClusterCollector__get_metric(
+        'dev0', 'size_total', info, label)
+    assert metric[7] == deadband
+    assert metric[0] == ['size_total' if label.startswith('-') else 'size']
+    assert metric[2] == 1
+
+
+@pytest.mark.parametrize('heartbeat, expected', [
+    (0, [True, False, False, False, False, True, False]),
+    (3, [True, False, False, True, False, True, False]),
+])
+def test_changes_published(heartbeat, expected):
+    collector = Collector()
+    collector.config['heartbeat_cycles'] = str(heartbeat)
+    metrics = {'size_total': (['size'], 'b', 1, '', None, True, None,
+                              (0.0, False))}
+    state = ObjectValues()
+    published = []
+    for value in ('10', '10', '10', '10', '10', '11', '11'):
+        values = collect(collector, metrics, {'size_total': value}, state)
+        published.append('vol0.size' in values)
+        state.expire(0)
+    assert published == expected
+
+
+RESPONSE = (
+    u'<?xml version="1.0" encoding="UTF-8"?>'
+    u'<netapp version="1.15" xmlns="http://www.netapp.com/filer/admin">'
+    u'<results status="passed" reason="été">'
+    u'<instances>'
+    u'<instance-data><name>vol0</name><uuid>node:kernel:vol0</uuid>'
+    u'<counters>'
+    u'<counter-data><name>total_ops</name><value>10</value>'
+    u'<aggregation><name>node</name><value>2</value></aggregation>'
+    u'</counter-data>'
+    u'<aggregation><name>vserver</name><value>3</value></aggregation>'
+    u'<counter-data><name>read_latency_hist</name>'
+    u'<value>1,2,3</value></counter-data>'
+    u'</counters></instance-data>'
+    u'<instance-data><name>volé1</name><counters>'
+    u'<counter-data><name>total_ops</name><value>5</value></counter-data>'
+    u'</counters></instance-data>'
+    u'<instance-data><counters>'
+    u'<counter-data><name>total_ops</name><value>1</value></counter-data>'
+    u'</counters></instance-data>'
+    u'</instances>'
+    u'<timestamp>1400000000</timestamp><next-tag>tag0</next-tag>'
+    u'</results></netapp>').encode('utf-8')
+
+
+def dom_instances(results):
+    """The instances of the response parsed as NaElement objects."""
+    instances = []
+    for instance in results.child_get('instances').children_get():
+        name = (instance.child_get_string('uuid') or
+                instance.child_get_string('name'))
+        if not name:
+            continue
+        counters = instance.child_get('counters').children_get()
+        counters = [(counter.child_get_string('name'),
+                     counter.child_get_string('value'))
+                    for counter in counters
+                    if counter.element['name'] == 'counter-data']
+        instances.append((name, counters))
+    return instances
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 64, len(RESPONSE)])
+def test_perf_instances_parser(chunk):
+    # pieces of 1 and 7 bytes end inside tags and inside the UTF-8
+    # sequences
+    server = ontapng.NaServer.NaServer('127.0.0.1', 1, 15)
+    dom = ontapng.NaServer.NaResponseParser(server)
+    dom.feed(RESPONSE)
+    dom = dom.close()
+    parser = ontapng.PerfInstancesParser(server)
+    for i in range(0, len(RESPONSE), chunk):
+        parser.feed(RESPONSE[i:i + chunk])
+    results = parser.close()
+    assert parser.instances == dom_instances(dom)
+    assert parser.instances == [
+        (u'node:kernel:vol0', [(u'total_ops', u'10'),
+                               (u'read_latency_hist', u'1,2,3')]),
+        (u'volé1', [(u'total_ops', u'5')])]
+    assert results.child_get_string('timestamp') == '1400000000'
+    assert results.child_get_string('next-tag') == 'tag0'
+    assert results.child_get('instances') is None
+    assert results.attr_get('reason') == dom.attr_get('reason')
+
+
+class Server(ontapng.NaServer.NaServer):
+    '''NaServer answering each request with the next canned response of
+    its api, the names of the apis invoked are kept in self.requests.
+    '''
+
+    def __init__(self, responses):
+        ontapng.NaServer.NaServer.__init__(self, 'filer', 1, 15)
+        self.responses = responses
+        self.requests = []
+
+    def invoke_elem(self, req, parser=None):
+        self.requests.append(req.element['name'])
+        response = self.responses[req.element['name']].pop(0)
+        if parser is None:
+            parser = ontapng.NaServer.NaResponseParser(self)
+        parser.feed(
+            '<?xml version="1.0" encoding="UTF-8"?><netapp version="1.15">'
+            '<results status="passed">%s</results></netapp>' % response)
+        return parser.close()
+
+
+class Metrics(ontapng.NetAppMetrics):
+    '''NetAppMetrics of a Server with the responses given.'''
+
+    def __init__(self, responses):
+        self.responses = responses
+        ontapng.NetAppMetrics.__init__(self, 'filer', 'root', '', '1.15')
+
+    def _connect(self, device, user, password, apiversion, timeout=None,
+                 method='HTTP'):
+        self.server = Server(self.responses)
+
+
+def instances_page(records):
+    """Content of a perf-object-get-instances-iter-next response with
+    the records [(instance, [(counter, value), ...]), ...].
+    """
+    instances = ''.join(
+        '<instance-data><name>%s</name><counters>%s</counters>'
+        '</instance-data>' % (name, ''.join(
+            '<counter-data><name>%s</name><value>%s</value>'
+            '</counter-data>' % counter for counter in counters))
+        for name, counters in records)
+    return ('<instances>%s</instances><records>%i</records>' % (
+        instances, len(records)))
+
+
+def test_sevenm_pages():
+    # the counters of vol1 and vol2 are split in two pages
+    responses = {
+        'system-get-version': [
+            '<version>NetApp Release 8.1.2 7-Mode</version>'],
+        'perf-object-get-instances-iter-start': [
+            '<tag>tag0</tag><timestamp>1400000000</timestamp>'
+            '<records>5</records>'],
+        'perf-object-get-instances-iter-next': [
+            instances_page([('vol0', [('a', '1'), ('b', '2')]),
+                            ('vol1', [('a', '3')])]),
+            instances_page([('vol1', [('b', '4')]),
+                            ('vol2', [('a', '5'), ('b', '6')])]),
+            instances_page([('vol2', [('c', '7')])])],
+        'perf-object-get-instances-iter-end': ['']}
+    expected = {'vol0': {'a': '1', 'b': '2'},
+                'vol1': {'a': '3', 'b': '4'},
+                'vol2': {'a': '5', 'b': '6', 'c': '7'}}
+    metrics = Metrics(dict((api, list(pages))
+                           for api, pages in responses.items()))
+    metrics.perf_max_records = 2
+    assert not metrics.clustered
+    pages = list(metrics.iter_metrics(
+        'volume', ['vol0', 'vol1', 'vol2'], ['a', 'b', 'c']))
+    assert [sorted(values) for values, times, instance_t in pages] == [
+        ['vol0'], ['vol1'], ['vol2']]
+    for values, times, instance_t in pages:
+        assert instance_t == 1400000000.0
+        assert sorted(times) == sorted(values)
+        for name, data in values.items():
+            assert data == expected[name]
+    assert metrics.server.requests == [
+        'system-get-version', 'perf-object-get-instances-iter-start'] + [
+        'perf-object-get-instances-iter-next'] * 3 + [
+        'perf-object-get-instances-iter-end']
+    assert not metrics.open_iterators()
+    metrics = Metrics(dict((api, list(pages))
+                           for api, pages in responses.items()))
+    metrics.perf_max_records = 2
+    values, times, instance_t = metrics.get_metrics(
+        'volume', ['vol0', 'vol1', 'vol2'], ['a', 'b', 'c'])
+    assert values == expected
+
+
+def special_element(cls=ontapng.NaServer.NaElement):
+    """Element with XML special characters and UTF-8 text."""
+    element = cls('qtree-create')
+    element.child_add_string('qtree', 'abc<qt0 & "x" > \'y\'')
+    element.child_add_string('volume', 'vol\xc3\xa9')
+    element.attr_set('reason', 'a&b "c" <d>')
+    return element
+
+
+def test_sprintf():
+    # as before, sprintf does not escape
+    assert special_element().sprintf() == (
+        '<qtree-create reason="a&b "c" <d>">\n'
+        '\t<qtree>abc<qt0 & "x" > \'y\'</qtree>\n'
+        '\t<volume>vol\xc3\xa9</volume>\n'
+        '</qtree-create>\n')
+
+
+@pytest.mark.parametrize('cls', [ontapng.NaServer.NaElement,
+                                 ontapng.CachedRequest])
+def test_encoded_string(cls):
+    element = cls('perf-object-get-instances')
+    element.child_add_string('objectname', 'volume')
+    element.child_add(cls('counters'))
+    assert element.toEncodedString() == (
+        '<perf-object-get-instances><objectname>volume</objectname>'
+        '<counters></counters></perf-object-get-instances>')
+    element = special_element(cls)
+    encoded = element.toEncodedString()
+    assert encoded == (
+        '<qtree-create reason="a&amp;b &quot;c&quot; &lt;d&gt;">'
+        '<qtree>abc&lt;qt0 &amp; &quot;x&quot; &gt; &apos;y&apos;</qtree>'
+        '<volume>vol\xc3\xa9</volume></qtree-create>')
+    assert element.toEncodedString() == encoded
+    # the values are the same once parsed
+    parser = ontapng.NaServer.NaResponseParser(Server({}))
+    parser.feed('<?xml version="1.0" encoding="UTF-8"?><netapp><results>'
+                '%s</results></netapp>' % encoded)
+    parsed = parser.close().child_get('qtree-create')
+    assert parsed.attr_get('reason') == 'a&b "c" <d>'
+    assert parsed.child_get_string('qtree') == 'abc<qt0 & "x" > \'y\''
+    assert parsed.child_get_string('volume') == u'vol\xe9'
+
+
+def template_path(pretty, device, instance, data):
+    """The metric path of the instance as it was built with Template."""
+    path = device
+    for item in pretty.split('.'):
+        item = item.replace('@', instance)
+        item = ontapng.Template(item).safe_substitute(data)
+        item = item.replace('.', '_').strip('_')
+        item = item.replace('/', '.').strip('.')
+        path += '.' + re.sub(r'[^a-zA-Z0-9._]', '_', item)
+    return path
+
+
+@pytest.mark.parametrize('pretty', [
+    'volumes.@', 'vservers.${vserver_name}.volumes.$instance_name',
+    'nodes.${node_name}.processor.@', 'a-b.$$x.${missing}_@.${node_name}',
+    'lun.${path}'])
+def test_pretty_path(pretty):
+    data = {'vserver_name': 'vs1', 'instance_name': 'vol.0',
+            'node_name': 'node 1', 'path': '/vol/vol0/lun0'}
+    pretty_path = ontapng.PrettyPath(pretty)
+    for instance in ('vol0', 'processor/0', 'vol.1', 'vol\xc3\xa9'):
+        path, paths = pretty_path.get('dev0', instance, data)
+        assert path == template_path(pretty, 'dev0', instance, data)
+
+
+def test_pretty_path_cache():
+    pretty_path = ontapng.PrettyPath('vservers.${vserver_name}.volumes.@')
+    data = {'vserver_name': 'vs1', 'total_ops': '1'}
+    path, paths = pretty_path.get('dev0', 'vol0', data)
+    assert path == 'dev0.vservers.vs1.volumes.vol0'
+    paths['total_ops'] = 'cached'
+    # hit: other counters change
+    data = {'vserver_name': 'vs1', 'total_ops': '2'}
+    assert pretty_path.get('dev0', 'vol0', data) == (path, paths)
+    # miss: the counter of the path changes, and the paths of the metrics
+    # are not reused
+    data = {'vserver_name': 'vs2', 'total_ops': '2'}
+    path, paths = pretty_path.get('dev0', 'vol0', data)
+    assert path == 'dev0.vservers.vs2.volumes.vol0'
+    assert paths == {}
+    pretty_path.get('dev0', 'vol1', data)
+    pretty_path.expire(['dev0.vservers.vs2.volumes.vol1'])
+    assert list(pretty_path.paths) == ['vol1']
+
+
+def test_name_generations():
+    metrics = Metrics({'system-get-version': [
+        '<version>NetApp Release 8.1.2 7-Mode</version>']})
+    metrics.max_cached_names = 2
+    instance_name = metrics._NetAppMetrics__instance_name
+    assert instance_name(u'vol.a') == 'vol_a'
+    assert instance_name(u'vol/b') == 'vol.b'
+    assert sorted(metrics.instance_names) == [u'vol.a', u'vol/b']
+    # full: a new generation is started
+    assert instance_name(u'vol_c') == 'vol_c'
+    assert sorted(metrics.old_names['instance_names']) == [
+        u'vol.a', u'vol/b']
+    assert list(metrics.instance_names) == [u'vol_c']
+    # vol.a is found in the previous generation and moved to the new one
+    assert instance_name(u'vol.a') == 'vol_a'
+    assert sorted(metrics.instance_names) == [u'vol.a', u'vol_c']
+    # vol/b is dropped with the previous generation
+    assert instance_name(u'vol\xe9d') == 'voled'
+    assert sorted(metrics.old_names['instance_names']) == [
+        u'vol.a', u'vol_c']
+    assert instance_name(u'vol/b') == 'vol.b'
+    assert metrics._NetAppMetrics__counter_name(u'total_ops') == 'total_ops'
+    assert list(metrics.counter_names) == [u'total_ops']
+
+
+def filled_state(instances):
+    """ObjectValues with the counters a and b of the instances set."""
+    state = ObjectValues()
+    for n, instance in enumerate(instances):
+        row = state.row(instance)
+        state.set(row, state.column('a'), n)
+        state.set(row, state.column('b'), n + 0.5)
+    return state
+
+
+def test_expire():
+    state = filled_state(['vol0', 'vol1', 'vol2'])
+    assert state.expire(2) == 0
+    assert state.series() == 6
+    # vol1 and vol2 are missing in two collections
+    for removed in (0, 2):
+        state.row('vol0')
+        assert state.expire(2) == removed
+    assert sorted(state.rows) == ['vol0']
+    assert state.series() == 2
+    # not collected, it does not count
+    assert state.expire(2) == 0
+    assert state.expire(2) == 0
+    # the rows are reused without the values of the removed instances
+    row = state.row('vol3')
+    assert row != state.rows['vol0']
+    value = state.get(row, state.column('a'))
+    assert value != value
+    assert state.series() == 2
+    # never with 0 cycles
+    state = filled_state(['vol0', 'vol1'])
+    for cycle in range(5):
+        state.row('vol0')
+        assert state.expire(0) == 0
+    assert sorted(state.rows) == ['vol0', 'vol1']
+
+
+def test_expire_values():
+    collector = Collector()
+    collector.config['expire_cycles'] = '2'
+    # the rows are the metric paths of the instances
+    paths = ['dev0.volumes.vol0', 'dev0.volumes.vol1', 'dev0.volumes.vol2']
+    volume = filled_state(paths)
+    removed = filled_state(['vol0'])
+    collector.last_values = {'dev0': {'volume': volume, 'lun': removed}}
+    collector.paths = {'dev0': {'volume': ontapng.PrettyPath('volumes.@')}}
+    for instance in ('vol0', 'vol1', 'vol2'):
+        collector.paths['dev0']['volume'].get('dev0', instance, {})
+    collector._expire_values('dev0', 1)
+    # the object not in the configuration anymore is removed
+    assert collector.published == {
+        'dev0.collector.series': 6, 'dev0.collector.evicted': 1}
+    assert list(collector.last_values['dev0']) == ['volume']
+    evicted = []
+    for cycle in range(2):
+        volume.row(paths[0])
+        collector.published = {}
+        collector._expire_values('dev0', 1)
+        evicted.append(collector.published['dev0.collector.evicted'])
+    assert evicted == [0, 2]
+    assert collector.published['dev0.collector.series'] == 2
+    assert list(collector.paths['dev0']['volume'].paths) == ['vol0']
+    # publish = 2: only when not 0
+    volume.row(paths[0])
+    collector.published = {}
+    collector._expire_values('dev0', 2)
+    assert collector.published == {'dev0.collector.series': 2}